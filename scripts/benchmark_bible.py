@@ -0,0 +1,85 @@
+"""benchmark_bible.py - compares memory use and load times of Bible storage formats
+
+Usage: python benchmark_bible.py <pickled .bbl file>
+"""
+
+import gc
+import os
+import pickle
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from bible import chunk_cache, open_bible, write_bible
+
+
+def load_pickle(filename):
+    with open(filename, 'rb') as fileobj:
+        metadata = pickle.load(fileobj)
+        ber_bible = pickle.load(fileobj)
+    ber_bible[0] = metadata
+    return ber_bible
+
+
+def measure(label, load):
+    gc.collect()
+    sec = time.perf_counter()
+    result = load()
+    msec = (time.perf_counter() - sec) * 1000
+    del result
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("%-28s %10.1f KiB %10.1f msec" % (label, size / 1024, msec))
+    return result
+
+
+def read_chapter(Bible, book, chapter):
+    return [Bible[book][chapter][v] for v in range(len(Bible[book][chapter]))]
+
+
+def time_chapter(label, load, book, chapter):
+    chunk_cache.clear()
+    sec = time.perf_counter()
+    Bible = load()
+    read_chapter(Bible, book, chapter)
+    cold = (time.perf_counter() - sec) * 1000
+    sec = time.perf_counter()
+    read_chapter(Bible, book, chapter)
+    warm = (time.perf_counter() - sec) * 1000
+    print("%-28s %10.2f msec %10.2f msec" % (label, cold, warm))
+    return Bible
+
+
+def main(filename):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        bbl_file = os.path.join(temp_dir, "bible.bbl")
+        zbbl_file = os.path.join(temp_dir, "bible-compressed.bbl")
+        write_bible(bbl_file, load_pickle(filename), False)
+        write_bible(zbbl_file, load_pickle(filename))
+        print("File sizes: %d KiB (pickle), %d KiB (uncompressed), %d KiB (compressed)\n" %
+              tuple(os.path.getsize(name) // 1024 for name in (filename, bbl_file, zbbl_file)))
+
+        print("%-28s %14s %15s" % ("Format", "Memory", "Load time"))
+        measure("Nested lists (pickle)", lambda: load_pickle(filename))
+        measure("Compact store (pickle)", lambda: open_bible(filename))
+        measure("Compact store (mmap)", lambda: open_bible(bbl_file)).close()
+        measure("Compressed chunks (mmap)", lambda: open_bible(zbbl_file)).close()
+
+        for book, chapter in ((1, 1), (19, 119)):
+            print("\n%-28s %15s %15s" % ("Chapter %d:%d" % (book, chapter), "Cold load",
+                                          "Warm load"))
+            time_chapter("Nested lists (pickle)", lambda: load_pickle(filename), book, chapter)
+            time_chapter("Compact store (mmap)", lambda: open_bible(bbl_file), book,
+                         chapter).close()
+            time_chapter("Compressed chunks (mmap)", lambda: open_bible(zbbl_file), book,
+                         chapter).close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
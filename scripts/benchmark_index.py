@@ -0,0 +1,75 @@
+"""benchmark_index.py - compares open and query times of search index formats
+
+Usage: python benchmark_index.py <.bbl file>
+"""
+
+import gc
+import os
+import pickle
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from bible import open_bible
+from constants import verse_reference
+from index import build_dictionaries, build_index, open_index, write_index
+
+QUERIES = ("the", "lord", "god", "israel", "love", "jerusalem", "melchizedek")
+
+
+def load_pickle(filename):
+    with open(filename, 'rb') as fileobj:
+        return pickle.load(fileobj)
+
+
+def decode_triples(references):
+    return [references[i:i + 3].encode("latin1") for i in range(0, len(references), 3)]
+
+
+def measure(label, function, repeat=1):
+    gc.collect()
+    sec = time.perf_counter()
+    for i in range(repeat):
+        result = function()
+    print("%-28s %10.2f msec" % (label, (time.perf_counter() - sec) * 1000 / repeat))
+    return result
+
+
+def main(filename):
+    Bible = open_bible(filename)
+    postings = build_index(Bible)[0]
+    Bible.close()
+    terms = [word for query in QUERIES for word in (query, query.capitalize(), query.upper())
+             if word in postings]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        triples_file = os.path.join(temp_dir, "triples.idx")
+        arrays_file = os.path.join(temp_dir, "arrays.idx")
+        index_file = os.path.join(temp_dir, "index.idx")
+        with open(triples_file, 'wb') as fileobj:  # Format used before verse ordinals
+            pickle.dump({word: "".join(chr(n) for ordinal in ordinals
+                                       for n in verse_reference(ordinal))
+                         for word, ordinals in postings.items()}, fileobj, -1)
+        with open(arrays_file, 'wb') as fileobj:
+            pickle.dump(postings, fileobj, -1)
+        write_index(index_file, *build_dictionaries(postings))
+        print("File sizes: %d KiB (triples), %d KiB (arrays), %d KiB (delta postings)\n" %
+              tuple(os.path.getsize(name) // 1024
+                    for name in (triples_file, arrays_file, index_file)))
+
+        print("%-28s %15s" % ("Cold open", "Time"))
+        triples = measure("Pickled triples", lambda: load_pickle(triples_file))
+        arrays = measure("Pickled arrays", lambda: load_pickle(arrays_file))
+        index = measure("Delta postings (mmap)", lambda: open_index(index_file))
+
+        print("\n%-28s %15s" % ("Decode %d terms" % len(terms), "Time"))
+        measure("Pickled triples", lambda: [decode_triples(triples[word]) for word in terms], 20)
+        measure("Pickled arrays", lambda: [arrays[word] for word in terms], 20)
+        measure("Delta postings (mmap)", lambda: [index.get(word) for word in terms], 20)
+        index.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,86 @@
+"""benchmark_live_search.py - measures searches run as a query is typed, from scratch and
+refined from the results of the search before them
+
+Usage: python benchmark_live_search.py <.bbl file>
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from bible import open_bible
+from engine import get_pattern, parse_query, refine, search_index
+from index import build_dictionaries, build_index, open_index, write_index
+
+QUERIES = ("the lord god of israel", "in the beginning", "faith hope charity",
+           "grace and peace from god our father", "jesus wept", "blessed are the meek")
+OPTIONS = {"AllWords": True, "CaseSensitive": False, "ExactMatch": False, "Phrase": False,
+           "RegularExpression": False}
+MIN_LENGTH = 2  # As in the search pane
+PAGE_SIZE = 100  # Verses that are shown first
+TARGET = 50  # Msec
+
+
+def show_page(Bible, matches, words, links):
+    # Highlights the first verses found, which is what a search shows before the rest
+    pattern = get_pattern(words, links, OPTIONS)
+    return [pattern.sub(r"<b>\g<0></b>", Bible.get_slot(item))
+            for item in matches[:PAGE_SIZE]]
+
+
+def type_query(Bible, index, query, live):
+    # Returns the msec that each keystroke takes to show results, and how many were refined
+    times = []
+    refined = 0
+    previous = None
+    for i in range(MIN_LENGTH, len(query) + 1):
+        words, links = parse_query(query[:i])
+        sec = time.perf_counter()
+        matches = refine(index, previous, words, links, OPTIONS) \
+            if live and previous is not None else None
+        if matches is None:
+            matches = search_index(index, Bible, words, links, OPTIONS)
+        else:
+            refined += 1
+        show_page(Bible, matches, words, links)
+        times.append((time.perf_counter() - sec) * 1000)
+        previous = (words, links, OPTIONS, matches)
+    return times, refined
+
+
+def summarize(times):
+    times = sorted(times)
+    return (times[len(times) // 2], times[min(len(times) - 1, len(times) * 95 // 100)],
+            times[-1], sum(1 for msec in times if msec > TARGET))
+
+
+def main(filename):
+    Bible = open_bible(filename)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_file = os.path.join(temp_dir, "index.idx")
+        write_index(index_file, *build_dictionaries(*build_index(Bible)))
+        index = open_index(index_file)
+        print("%-36s %5s %28s %28s" % ("Query", "Keys", "From scratch (msec)",
+                                       "Refined (msec)"))
+        print("%-36s %5s %28s %28s" % ("", "", "median   p95   max >%d" % TARGET,
+                                       "median   p95   max >%d" % TARGET))
+        totals = ([], [])
+        for query in QUERIES:
+            row = []
+            for live in (False, True):
+                times, refined = type_query(Bible, index, query, live)
+                totals[live].extend(times)
+                row.extend(summarize(times))
+            print("%-36s %5d %7.1f %5.1f %5.1f %4d %9.1f %5.1f %5.1f %4d" %
+                  ((query, len(times)) + tuple(row)))
+        print("%-36s %5d %7.1f %5.1f %5.1f %4d %9.1f %5.1f %5.1f %4d" %
+              (("All", len(totals[0])) + summarize(totals[0]) + summarize(totals[1])))
+        index.close()
+    Bible.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
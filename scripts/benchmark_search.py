@@ -0,0 +1,68 @@
+"""benchmark_search.py - compares multi-word search with and without postings intersection
+
+Usage: python benchmark_search.py <.bbl file>
+"""
+
+import os
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "src"))
+
+from bible import open_bible
+from engine import find_all, find_term, get_postings
+from index import build_dictionaries, build_index, fold, get_tokens, open_index, write_index
+
+QUERIES = ("the lord god of israel", "in the beginning", "faith hope charity",
+           "grace and peace from god our father", "jesus wept")
+
+
+def find_by_text(Bible, index, words, exact):
+    # Seeds candidates with the longest word and filters them by the text of each verse, split
+    # into terms the way the index is for exact matches
+    longest = max(reversed(words), key=len)
+    matches = get_postings(*find_term(index, longest, exact))
+    for word in words:
+        if word == longest:
+            continue
+        elif exact:
+            matches = [item for item in matches
+                       if fold(word) in map(fold, get_tokens(Bible.get_slot(item)))]
+        else:
+            pattern = re.compile(word, re.IGNORECASE)
+            matches = [item for item in matches if pattern.search(Bible.get_slot(item))]
+    return matches
+
+
+def measure(function, repeat=5):
+    sec = time.perf_counter()
+    for i in range(repeat):
+        result = function()
+    return len(result), (time.perf_counter() - sec) * 1000 / repeat
+
+
+def main(filename):
+    Bible = open_bible(filename)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        index_file = os.path.join(temp_dir, "index.idx")
+        write_index(index_file, *build_dictionaries(build_index(Bible)[0]))
+        index = open_index(index_file)
+        for exact in (True, False):
+            print("%s match" % ("Exact" if exact else "Substring"))
+            print("%-40s %20s %20s" % ("Query", "Text filter", "Intersection"))
+            for query in QUERIES:
+                words = query.split()
+                text_filter = measure(lambda: find_by_text(Bible, index, words, exact))
+                intersection = measure(lambda: find_all(index, words, exact))
+                assert text_filter[0] == intersection[0], "%s found different verses" % query
+                print("%-40s %7d %7.2f msec %7d %7.2f msec" %
+                      ((query,) + text_filter + intersection))
+            print()
+        index.close()
+    Bible.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -15,6 +15,7 @@ import wx
 
 import bugreport
 import mainwindow
+from bible import apply_pending_bibles
 
 _ = wx.GetTranslation
 
@@ -73,6 +74,8 @@ class FileConfig(wx.FileConfig):
         self.WriteList("SearchHistory", frame.search.text.GetStrings())
         self.WriteInt("AbbrevResults", frame.search.abbrev_results)
         self.WriteBool("ShowOptions", frame.search.optionspane.IsExpanded())
+        self.WriteBool("LiveSearch", frame.search.live_search.GetValue())
+        self.WriteList("PositionlessVersions", frame.search.positionless_versions)
         for option in frame.search.options:
             self.WriteBool(option, getattr(frame.search, option).GetValue())
         self.SetPath("/MultiVerse")
@@ -137,6 +140,8 @@ class Berean(wx.App):
     def CreateFrame(self, show=True):
         if hasattr(self, "frame"):
             del self.frame
+        for dirname in (os.path.join(self.cwd, "versions"), self.version_dir):
+            apply_pending_bibles(dirname)
         self.frame = mainwindow.MainWindow(self)
         self.restart = False
         self.SetTopWindow(self.frame)
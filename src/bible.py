@@ -0,0 +1,461 @@
+"""bible.py - Bible file reading and writing"""
+
+import glob
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+from itertools import accumulate, count
+
+from constants import (BOOK_CHAPTER_OFFSETS, BOOK_LENGTHS, BOOK_VERSE_OFFSETS, CHAPTER_COUNT,
+                       CHAPTER_LENGTHS, CHAPTER_VERSE_OFFSETS, ORDINAL_BOOKS, VERSE_COUNT)
+
+MAGIC = b"BRBL"
+FORMAT_VERSION = 2
+FLAG_COMPRESSED = 0x1
+FLAG_TAGS = 0x2
+
+# Magic, format version, flags, slot count, then (offset, length) of the metadata, presence,
+# offset table, chunk table and text sections
+HEADER = struct.Struct("<4sHHI10Q")
+# Language and description, so that they can be read without parsing the metadata section
+LANG_SIZE = 32
+DESCRIPTION_SIZE = 256
+INFO = struct.Struct("<%ds%ds" % (LANG_SIZE, DESCRIPTION_SIZE))
+# Offset and length of the tags section, which follows the info if the file has tags
+TAGS = struct.Struct("<2Q")
+# Length of the tag strings, at the start of the tags section
+TAG_STRINGS = struct.Struct("<I")
+_RANGE = struct.Struct("<2I")
+
+BOOK_COUNT = len(BOOK_LENGTHS)
+
+# Verses are stored in canonical order, followed by chapter subtitles and then book colophons
+SLOT_COUNT = VERSE_COUNT + CHAPTER_COUNT + BOOK_COUNT
+
+# Each book is compressed separately, and subtitles and colophons share the last chunk
+_CHUNK_SLOTS = BOOK_VERSE_OFFSETS + (SLOT_COUNT,)
+CHUNK_COUNT = len(_CHUNK_SLOTS) - 1
+
+
+def _get_slot(book, chapter=0, verse=0):
+    if chapter == 0:
+        return VERSE_COUNT + CHAPTER_COUNT + book - 1
+    chapter_index = BOOK_CHAPTER_OFFSETS[book - 1] + chapter - 1
+    if verse == 0:
+        return VERSE_COUNT + chapter_index
+    return CHAPTER_VERSE_OFFSETS[chapter_index] + verse - 1
+
+
+def _check_index(i, length):
+    if not 0 <= i < length:
+        raise IndexError("index out of range")
+
+
+def _load_pickle(fileobj):
+    metadata = pickle.load(fileobj)
+    ber_bible = pickle.load(fileobj)
+    ber_bible[0] = metadata
+    return ber_bible
+
+
+def open_bible(filename):
+    with open(filename, 'rb') as fileobj:
+        if fileobj.read(len(MAGIC)) == MAGIC:
+            return Bible.from_file(filename)
+        fileobj.seek(0)
+        ber_bible = _load_pickle(fileobj)
+    return Bible(ber_bible[0], *pack_bible(ber_bible))
+
+
+def upgrade_bible(filename):
+    # Rewrites a Bible in the pickled format of older versions of Berean in the current one, so
+    # that it is memory-mapped instead of unpickled by every process that opens it
+    with open(filename, 'rb') as fileobj:
+        if fileobj.read(len(MAGIC)) == MAGIC:
+            return False
+        fileobj.seek(0)
+        ber_bible = _load_pickle(fileobj)
+    write_bible(filename, ber_bible)
+    return True
+
+
+def read_metadata(filename):
+    with open(filename, 'rb') as fileobj:
+        header = fileobj.read(HEADER.size + INFO.size)
+        if not header.startswith(MAGIC):
+            fileobj.seek(0)
+            metadata = pickle.load(fileobj)
+            return {"lang": metadata.get("lang", ""), "description": metadata["description"]}
+    if len(header) < HEADER.size + INFO.size:
+        raise ValueError("%s is not a supported Bible file" % filename)
+    lang, description = [field.rstrip(b"\0").decode("utf-8")
+                         for field in INFO.unpack_from(header, HEADER.size)]
+    return {"lang": lang, "description": description}
+
+
+def _pack_field(text, size):
+    return text.encode("utf-8")[:size].decode("utf-8", "ignore").encode("utf-8")
+
+
+def pack_bible(ber_bible):
+    presence = bytearray(BOOK_COUNT + CHAPTER_COUNT)
+    texts = [b""] * SLOT_COUNT
+    for b in range(1, min(len(ber_bible), BOOK_COUNT + 1)):
+        book = ber_bible[b]
+        if not book:
+            continue
+        presence[b - 1] = 1
+        texts[_get_slot(b)] = (book[0] or "").encode("utf-8")
+        for c in range(1, min(len(book), BOOK_LENGTHS[b - 1] + 1)):
+            if not book[c]:
+                continue
+            presence[BOOK_COUNT + BOOK_CHAPTER_OFFSETS[b - 1] + c - 1] = 1
+            for v in range(min(len(book[c]), CHAPTER_LENGTHS[b - 1][c - 1] + 1)):
+                texts[_get_slot(b, c, v)] = (book[c][v] or "").encode("utf-8")
+    offsets = array("I", [0])
+    for text in texts:
+        offsets.append(offsets[-1] + len(text))
+    return bytes(presence), offsets, b"".join(texts)
+
+
+def pack_uint32(values):
+    values = array("I", values)
+    if sys.byteorder != "little":
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_uint32(buffer, start, stop):
+    if sys.byteorder == "little":
+        return memoryview(buffer)[start:stop].cast("I")
+    values = array("I", buffer[start:stop])
+    values.byteswap()
+    return values
+
+
+def pack_tags(tags):
+    # Packs the (run, lemma, morph) tuples of each word in tags, which maps (book, chapter, verse)
+    # to them, into a table of strings and a compressed chunk of records for each book
+    tags = {_get_slot(*reference): values for reference, values in tags.items()}
+    strings = {None: 0}
+    chunks = []
+    for b in range(BOOK_COUNT):
+        offsets = array("I", [0])
+        records = array("I")
+        for ordinal in range(BOOK_VERSE_OFFSETS[b], BOOK_VERSE_OFFSETS[b + 1]):
+            for run, lemma, morph in tags.get(ordinal, ()):
+                records.extend((run, strings.setdefault(lemma, len(strings)),
+                                strings.setdefault(morph, len(strings))))
+            offsets.append(len(records) // 3)
+        chunks.append(zlib.compress(pack_uint32(offsets) + pack_uint32(records), 9))
+    names = "\0".join(list(strings)[1:]).encode("utf-8")
+    return (TAG_STRINGS.pack(len(names)) + names +
+            pack_uint32(accumulate([0] + list(map(len, chunks)))) + b"".join(chunks))
+
+
+def write_bible(filename, ber_bible, compress=True, tags=None):
+    presence, offsets, text = pack_bible(ber_bible)
+    metadata = json.dumps(ber_bible[0], default=str).encode("utf-8")
+    flags = 0
+    chunk_table = b""
+    if compress:
+        flags |= FLAG_COMPRESSED
+        chunks = [zlib.compress(text[offsets[_CHUNK_SLOTS[i]]:offsets[_CHUNK_SLOTS[i + 1]]], 9)
+                  for i in range(CHUNK_COUNT)]
+        chunk_offsets = [0]
+        for chunk in chunks:
+            chunk_offsets.append(chunk_offsets[-1] + len(chunk))
+        chunk_table = pack_uint32(chunk_offsets)
+        text = b"".join(chunks)
+    offset_table = pack_uint32(offsets)
+
+    info = INFO.pack(_pack_field(ber_bible[0].get("lang", ""), LANG_SIZE),
+                     _pack_field(ber_bible[0].get("description", ""), DESCRIPTION_SIZE))
+    tag_section = b""
+    if tags:
+        flags |= FLAG_TAGS
+        tag_section = pack_tags(tags)
+    sections = []
+    position = HEADER.size + INFO.size + (TAGS.size if tags else 0)
+    for section in (metadata, presence, offset_table, chunk_table, text):
+        sections.extend((position, len(section)))
+        position += len(section)
+    temp_file = filename + ".tmp"
+    with open(temp_file, 'wb') as fileobj:
+        fileobj.write(HEADER.pack(MAGIC, FORMAT_VERSION, flags, SLOT_COUNT, *sections))
+        fileobj.write(info)
+        if tags:  # Older versions of Berean ignore the flag, and do not read the tags
+            fileobj.write(TAGS.pack(position, len(tag_section)))
+        for section in (metadata, presence, offset_table, chunk_table, text, tag_section):
+            fileobj.write(section)
+    replace_bible(temp_file, filename)
+
+
+def replace_bible(temp_file, filename):
+    # Readers keep their existing mapping of the old file. Windows cannot replace a Bible while
+    # it is mapped, so the new file is left beside it until apply_pending_bibles is called
+    try:
+        os.replace(temp_file, filename)
+    except PermissionError:
+        os.replace(temp_file, filename + ".new")
+
+
+def remove_bible(filename):
+    try:
+        os.remove(filename)
+    except PermissionError:
+        open(filename + ".new", 'wb').close()  # An empty side file marks the Bible as deleted
+
+
+def is_removed(filename):
+    return os.path.isfile(filename + ".new") and os.path.getsize(filename + ".new") == 0
+
+
+def apply_pending_bibles(dirname):
+    # Makes the changes left by replace_bible and remove_bible, before any Bible is opened
+    for side_file in glob.glob(os.path.join(dirname, "*.bbl.new")):
+        filename = side_file[:-len(".new")]
+        try:
+            if os.path.getsize(side_file) > 0:
+                os.replace(side_file, filename)
+            else:
+                if os.path.isfile(filename):
+                    os.remove(filename)
+                os.remove(side_file)
+        except OSError:  # The Bible is still open, so it is left for the next start
+            pass
+
+
+class VersionCatalog:
+    def __init__(self, filename):
+        self._filename = filename
+        self._entries = {}
+        self._modified = False
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as fileobj:
+                    self._entries = pickle.load(fileobj)
+            except (EOFError, pickle.UnpicklingError):
+                pass
+
+    def get_metadata(self, filename):
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        entry = self._entries.get(path)
+        if entry is None or entry[:2] != (stat.st_mtime_ns, stat.st_size):
+            entry = (stat.st_mtime_ns, stat.st_size, read_metadata(path))
+            self._entries[path] = entry
+            self._modified = True
+        return entry[2]
+
+    def prune(self, filenames):
+        paths = {os.path.abspath(filename) for filename in filenames}
+        for path in [path for path in self._entries if path not in paths]:
+            del self._entries[path]
+            self._modified = True
+
+    def save(self):
+        if self._modified:
+            with open(self._filename, 'wb') as fileobj:
+                pickle.dump(self._entries, fileobj, -1)
+            self._modified = False
+
+
+class ChunkCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._chunks = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            data = self._chunks.get(key)
+            if data is not None:
+                self._chunks.move_to_end(key)
+                return data
+        data = load()
+        with self._lock:
+            if key not in self._chunks:
+                self._chunks[key] = data
+                self._size += len(data)
+            while self._size > self.max_size and len(self._chunks) > 1:
+                self._size -= len(self._chunks.popitem(False)[1])
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self._size = 0
+
+
+chunk_cache = ChunkCache(16 * 1024 * 1024)  # Shared by all open Bibles
+_bible_ids = count()
+
+
+class Bible(Sequence):
+    def __init__(self, metadata, presence, offsets, text, text_start=0, chunks=None, tags=None):
+        super().__init__()
+        self.metadata = metadata
+        self._presence = presence
+        self._offsets = offsets
+        self._text = text
+        self._text_start = text_start
+        self._chunks = chunks
+        self._tags = tags
+        self._tag_strings = None
+        self._tag_chunks = None
+        self._tag_chunks_start = 0
+        self._id = next(_bible_ids)
+        self._checksum = None
+        self._verse_bitmap = None
+
+    @classmethod
+    def from_file(cls, filename):
+        with open(filename, 'rb') as fileobj:
+            buffer = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, slot_count, *sections = HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION or slot_count != SLOT_COUNT:
+            buffer.close()
+            raise ValueError("%s is not a supported Bible file" % filename)
+        metadata, presence, offsets, chunks, text = [(sections[i], sections[i] + sections[i + 1])
+                                                     for i in range(0, len(sections), 2)]
+        chunk_table = None
+        if flags & FLAG_COMPRESSED:
+            chunk_table = unpack_uint32(buffer, *chunks)
+        tags = None
+        if flags & FLAG_TAGS:
+            offset, length = TAGS.unpack_from(buffer, HEADER.size + INFO.size)
+            tags = (offset, offset + length)
+        return cls(json.loads(buffer[slice(*metadata)].decode("utf-8")),
+                   buffer[slice(*presence)], unpack_uint32(buffer, *offsets), buffer, text[0],
+                   chunk_table, tags)
+
+    def close(self):
+        for table in (self._offsets, self._chunks, self._tag_chunks):
+            if isinstance(table, memoryview):
+                table.release()
+        if isinstance(self._text, mmap.mmap):
+            self._text.close()
+
+    def get_checksum(self):
+        # SHA-1 of the verse text and layout, which is all that search indexes depend on
+        if self._checksum is None:
+            checksum = hashlib.sha1(self._presence)
+            checksum.update(self._offsets)
+            with memoryview(self._text) as text:
+                checksum.update(text[self._text_start:])
+            self._checksum = checksum.digest()
+        return self._checksum
+
+    def get_verse_bitmap(self):
+        # Int with bit n set if verse ordinal n has text, as in index.to_bitmap
+        if self._verse_bitmap is None:
+            offsets = self._offsets
+            self._verse_bitmap = int("".join("1" if offsets[i] != offsets[i + 1] else "0"
+                                             for i in range(VERSE_COUNT - 1, -1, -1)), 2)
+        return self._verse_bitmap
+
+    def has_book(self, book):
+        return self._presence[book - 1] != 0
+
+    def has_chapter(self, book, chapter):
+        return self._presence[BOOK_COUNT + BOOK_CHAPTER_OFFSETS[book - 1] + chapter - 1] != 0
+
+    def get_text(self, book, chapter=0, verse=0):
+        return self.get_slot(_get_slot(book, chapter, verse))
+
+    def get_slot(self, slot):
+        start = self._offsets[slot]
+        stop = self._offsets[slot + 1]
+        if self._chunks is None:
+            return self._text[self._text_start + start:self._text_start + stop].decode("utf-8")
+        chunk = ORDINAL_BOOKS[slot] - 1 if slot < VERSE_COUNT else CHUNK_COUNT - 1
+        data = chunk_cache.get((self._id, chunk), lambda: self._load_chunk(chunk))
+        chunk_start = self._offsets[_CHUNK_SLOTS[chunk]]
+        return data[start - chunk_start:stop - chunk_start].decode("utf-8")
+
+    def has_tags(self):
+        return self._tags is not None
+
+    def get_tags(self, ordinal):
+        # Returns the (run, lemma, morph) of the words of a verse that were tagged in the module
+        if self._tags is None:
+            return []
+        if self._tag_strings is None:
+            start = self._tags[0] + TAG_STRINGS.size
+            stop = start + TAG_STRINGS.unpack_from(self._text, self._tags[0])[0]
+            self._tag_strings = [None] + self._text[start:stop].decode("utf-8").split("\0")
+            self._tag_chunks_start = stop + 4 * (BOOK_COUNT + 1)
+            self._tag_chunks = unpack_uint32(self._text, stop, self._tag_chunks_start)
+        book = ORDINAL_BOOKS[ordinal] - 1
+        data = chunk_cache.get((self._id, "tags", book), lambda: self._load_tags(book))
+        first, last = _RANGE.unpack_from(data, 4 * (ordinal - BOOK_VERSE_OFFSETS[book]))
+        start = 4 * (BOOK_VERSE_OFFSETS[book + 1] - BOOK_VERSE_OFFSETS[book] + 1)
+        records = unpack_uint32(data, start + 12 * first, start + 12 * last)
+        strings = self._tag_strings
+        return [(records[i], strings[records[i + 1]], strings[records[i + 2]])
+                for i in range(0, len(records), 3)]
+
+    def _load_tags(self, book):
+        start = self._tag_chunks_start
+        return zlib.decompress(self._text[start + self._tag_chunks[book]:
+                                          start + self._tag_chunks[book + 1]])
+
+    def _load_chunk(self, chunk):
+        start = self._text_start + self._chunks[chunk]
+        stop = self._text_start + self._chunks[chunk + 1]
+        return zlib.decompress(self._text[start:stop])
+
+    def __getitem__(self, i):
+        _check_index(i, BOOK_COUNT + 1)
+        if i == 0:
+            return self.metadata
+        elif not self.has_book(i):
+            return None
+        return Book(self, i)
+
+    def __len__(self):
+        return BOOK_COUNT + 1
+
+
+class Book(Sequence):
+    def __init__(self, bible, book):
+        super().__init__()
+        self._bible = bible
+        self._book = book
+
+    def __getitem__(self, i):
+        _check_index(i, len(self))
+        if i == 0:
+            return self._bible.get_text(self._book)
+        elif not self._bible.has_chapter(self._book, i):
+            return None
+        return Chapter(self._bible, self._book, i)
+
+    def __len__(self):
+        return BOOK_LENGTHS[self._book - 1] + 1
+
+
+class Chapter(Sequence):
+    def __init__(self, bible, book, chapter):
+        super().__init__()
+        self._bible = bible
+        self._book = book
+        self._chapter = chapter
+
+    def __getitem__(self, i):
+        _check_index(i, len(self))
+        return self._bible.get_text(self._book, self._chapter, i)
+
+    def __len__(self):
+        return CHAPTER_LENGTHS[self._book - 1][self._chapter - 1] + 1
@@ -1,5 +1,7 @@
 """constants.py - global variables used throughout Berean"""
 
+from array import array
+
 VERSION = "0.5.0"
 
 BOOK_NAMES = (
@@ -117,11 +119,66 @@ CHAPTER_LENGTHS = (
     (20, 29, 22, 11, 14, 17, 17, 13, 21, 11, 19, 17, 18, 20, 8, 21, 18, 24, 21, 15, 27, 21),
 )
 
+CHAPTER_COUNT = sum(BOOK_LENGTHS)
+
+# Every verse has an ordinal, from 0 for Genesis 1:1 to VERSE_COUNT - 1 for Revelation 22:21
+BOOK_CHAPTER_OFFSETS = [0]  # Index of the first chapter of each book, and CHAPTER_COUNT
+for _length in BOOK_LENGTHS:
+    BOOK_CHAPTER_OFFSETS.append(BOOK_CHAPTER_OFFSETS[-1] + _length)
+BOOK_CHAPTER_OFFSETS = tuple(BOOK_CHAPTER_OFFSETS)
+CHAPTER_VERSE_OFFSETS = [0]  # Ordinal of the first verse of each chapter, and VERSE_COUNT
+for _lengths in CHAPTER_LENGTHS:
+    for _length in _lengths:
+        CHAPTER_VERSE_OFFSETS.append(CHAPTER_VERSE_OFFSETS[-1] + _length)
+CHAPTER_VERSE_OFFSETS = tuple(CHAPTER_VERSE_OFFSETS)
+BOOK_VERSE_OFFSETS = tuple(CHAPTER_VERSE_OFFSETS[i] for i in BOOK_CHAPTER_OFFSETS)
+VERSE_COUNT = CHAPTER_VERSE_OFFSETS[-1]
+
+ORDINAL_BOOKS = array("B")
+ORDINAL_CHAPTERS = array("B")
+ORDINAL_VERSES = array("B")
+for _book, _lengths in enumerate(CHAPTER_LENGTHS, 1):
+    for _chapter, _length in enumerate(_lengths, 1):
+        ORDINAL_BOOKS.extend([_book] * _length)
+        ORDINAL_CHAPTERS.extend([_chapter] * _length)
+        ORDINAL_VERSES.extend(range(1, _length + 1))
+
+
+def verse_ordinal(book, chapter, verse):
+    if not (0 < book <= len(BOOK_LENGTHS) and 0 < chapter <= BOOK_LENGTHS[book - 1] and
+            0 < verse <= CHAPTER_LENGTHS[book - 1][chapter - 1]):
+        raise IndexError("%d:%d:%d is not a valid reference" % (book, chapter, verse))
+    return CHAPTER_VERSE_OFFSETS[BOOK_CHAPTER_OFFSETS[book - 1] + chapter - 1] + verse - 1
+
+
+def verse_reference(ordinal):
+    return ORDINAL_BOOKS[ordinal], ORDINAL_CHAPTERS[ordinal], ORDINAL_VERSES[ordinal]
+
+
+def verse_references(ordinals):
+    return list(zip(map(ORDINAL_BOOKS.__getitem__, ordinals),
+                    map(ORDINAL_CHAPTERS.__getitem__, ordinals),
+                    map(ORDINAL_VERSES.__getitem__, ordinals)))
+
+
 BOOK_RANGES = (
     (1, 66), (1, 39), (1, 5), (6, 17), (18, 22), (23, 27), (28, 39), (40, 66), (40, 44), (45, 58),
     (59, 65), (66, 66),
 )
 
+
+def get_range_bitmap(start, stop):
+    # Returns the verse bitmap of the ordinals from start to stop (see index.to_bitmap)
+    bitmap = _range_bitmaps.get((start, stop))
+    if bitmap is None:
+        bitmap = _range_bitmaps[(start, stop)] = ((1 << (stop - start)) - 1) << start
+    return bitmap
+
+
+_range_bitmaps = {}  # Custom ranges are added when they are first searched
+for _first, _last in BOOK_RANGES:
+    get_range_bitmap(BOOK_VERSE_OFFSETS[_first - 1], BOOK_VERSE_OFFSETS[_last])
+
 FONT_SIZES = [str(i) for i in (8, 9, 10, 11, 12, 14, 16, 18, 20, 22, 24, 26, 28, 36, 48, 72)]
 
 LICENSE_TEXT = """This Source Code Form is subject to the terms of the Mozilla Public
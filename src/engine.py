@@ -0,0 +1,1095 @@
+"""engine.py - search engine stages that do not depend on the user interface"""
+
+import heapq
+import os
+import pickle
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from itertools import chain
+
+try:
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_constants
+    import sre_parse
+
+from bible import open_bible
+from constants import BOOK_NAMES, BOOK_VERSE_OFFSETS, VERSE_COUNT, get_range_bitmap
+from index import (CJK, DIACRITICS, GRAM_SIZE, MARKS, QUOTES, STRONGS, decode_deltas,
+                   encode_deltas, fold, fold_case, from_bitmap, get_fingerprint, get_grams,
+                   get_runs, has_cjk, open_index, split_cjk, to_bitmap, unify_quotes)
+from refalize import get_book_index
+
+WILDCARD = "*"
+NEAR = re.compile(r"NEAR/(\d+)\Z")
+RUN = re.compile(r"[%s]|(?:[^\W%s]|[*%s])+" % (CJK, CJK, MARKS))
+SUGGESTION_CANDIDATES = 500  # Terms sharing the most n-grams with a word that are compared to it
+MAX_STRINGS = 16  # Strings that regular expression analysis keeps track of before giving up
+MAX_CLASS = 8  # Characters in a set like [aeiou] that are tried one by one
+ENOUGH_CANDIDATES = 64  # Trigrams are not intersected further once they leave so few verses
+OPERATORS = ("AND", "OR", "NOT")
+BOOLEAN = re.compile(r"[\"()]|\b(?:AND|OR|NOT)\b|\b(?i:book):")
+QUERY_TOKEN = re.compile(r"\s*(?:([()])|\"([^\"]*)\"?|([^\W\d]\w*):(\"[^\"]*\"?|[^\s()\"]*)|"
+                         r"([^\s()\"]+))")
+# Like \b, but words can start and end anywhere in CJK text
+WORD_START = r"(?<![^\W%s])" % CJK
+WORD_END = r"(?![^\W%s])" % CJK
+
+_fold_classes = None
+
+
+def _get_fold_classes():
+    # Maps each folded character to the characters that fold to it, e.g., "a" to "aAáÁà..."
+    global _fold_classes
+    if _fold_classes is None:
+        _fold_classes = {}
+        for char in map(chr, range(0x10000)):
+            folded = fold(char)
+            if len(folded) == 1 and folded != char:
+                _fold_classes.setdefault(folded, [folded]).append(char)
+    return _fold_classes
+
+
+def _escape(text):
+    return re.escape(text).replace("'", "['%s]" % QUOTES)
+
+
+def _fold_pattern(text):
+    # Matches text with any case and diacritics, whether they are precomposed or not
+    classes = _get_fold_classes()
+    return "".join("%s[%s]*" % ("[%s]" % re.escape("".join(classes[char])) if char in classes
+                                else _escape(char), DIACRITICS) for char in fold(text))
+
+
+def term_pattern(word, case_sensitive=True):
+    escape = _escape if case_sensitive else _fold_pattern
+    return (r"[\w'\-%s]*" % MARKS).join(escape(part) for part in word.split(WILDCARD))
+
+
+def _get_matcher(word):
+    if WILDCARD in word:
+        return re.compile(r"%s\Z" % ".*".join(map(re.escape, word.split(WILDCARD)))).match
+    return lambda term: word in term
+
+
+def _get_token_matcher(word, case_sensitive=False):
+    if WILDCARD in word:
+        match = _get_matcher(word if case_sensitive else fold(word))
+    else:
+        match = (word if case_sensitive else fold(word)).__eq__
+    if case_sensitive:
+        return match
+    return lambda token: match(fold(token))
+
+
+def parse_near(words):
+    # Removes NEAR/n operators from words, and returns the remaining words along with the
+    # (first word, second word, distance) of each operator
+    terms = []
+    links = []
+    distance = None
+    for word in words:
+        match = NEAR.match(word)
+        if match:
+            distance = int(match.group(1)) if terms else None
+            continue
+        terms.append(word)
+        if distance is not None:
+            links.append((len(terms) - 2, len(terms) - 1, distance))
+            distance = None
+    return terms, links
+
+
+def expand_term(index, word, case_sensitive=False):
+    # Returns a dictionary of the index, and the ids of its terms that contain word or that
+    # match it if it has wildcards
+    folded = fold(word)
+    if WILDCARD in word:
+        fragments = ("^%s$" % folded).split(WILDCARD)
+    else:
+        fragments = [folded]
+    fragments = [fragment for fragment in fragments if fragment not in ("", "^", "$")]
+    if not fragments:
+        ids = range(len(index.folded))
+    elif len(fragments) == 1 and len(fragments[0]) <= GRAM_SIZE:
+        ids = index.grams.get(fragments[0], ())  # Matches exactly the terms that were asked for
+    else:
+        postings = []
+        for fragment in fragments:
+            size = min(len(fragment), GRAM_SIZE)
+            postings.extend(index.grams.get(gram, ()) for gram in get_grams(fragment)
+                            if len(gram) == size)
+        postings.sort(key=len)
+        ids = set(postings[0])
+        for values in postings[1:]:
+            ids.intersection_update(values)
+        match = _get_matcher(folded)
+        ids = [i for i in sorted(ids) if match(index.folded.get_key(i))]
+    if not case_sensitive:
+        return index.folded, ids
+    match = _get_matcher(word)
+    ids = sorted(j for i in ids for j in index.variants.get_values(i))
+    return index.terms, [i for i in ids if match(index.terms.get_key(i))]
+
+
+def get_positions(index, run):
+    if WILDCARD in run:
+        match = _get_matcher(fold(run))
+        runs = set()
+        for i in expand_term(index, "%s%s%s" % (WILDCARD, run, WILDCARD))[1]:
+            runs.update(run2 for run2 in get_runs(index.folded.get_key(i)) if match(run2))
+    else:
+        runs = {fold(run)}
+    positions = [index.positions.get(run2, ()) for run2 in runs]
+    if len(positions) == 1:
+        return positions[0]
+    return sorted(chain.from_iterable(positions))
+
+
+def _get_verse(index, position):
+    return bisect_right(index.starts, position) - 1
+
+
+def _contains(values, value):
+    i = bisect_left(values, value)
+    return i < len(values) and values[i] == value
+
+
+def get_phrase_positions(index, runs):
+    # Returns the positions where runs start in order, without crossing the end of a verse
+    positions = [get_positions(index, run) for run in runs]
+    if len(runs) == 1:
+        return positions[0]
+    rarest = min(range(len(runs)), key=lambda i: len(positions[i]))
+    matches = []
+    for position in positions[rarest]:
+        start = position - rarest
+        if (start >= 0 and start + len(runs) <= index.starts[_get_verse(index, start) + 1] and
+                all(_contains(values, start + i) for i, values in enumerate(positions)
+                    if i != rarest)):
+            matches.append(start)
+    return matches
+
+
+def find_phrase(index, words):
+    # Returns the ordinals of verses that contain words in order, using the positional index
+    runs = list(chain.from_iterable(map(RUN.findall, words)))
+    return sorted({_get_verse(index, position) for position in get_phrase_positions(index, runs)})
+
+
+def find_near(index, first, second, distance):
+    # Returns the ordinals of verses where the two words are at most distance words apart
+    positions = get_phrase_positions(index, RUN.findall(first))
+    positions2 = get_phrase_positions(index, RUN.findall(second))
+    if len(positions) > len(positions2):
+        positions, positions2 = positions2, positions
+    matches = set()
+    for position in positions:
+        verse = _get_verse(index, position)
+        if verse in matches:
+            continue
+        i = bisect_left(positions2, max(position - distance, index.starts[verse]))
+        if i < len(positions2) and positions2[i] == position:
+            i += 1
+        if i < len(positions2) and positions2[i] < min(position + distance + 1,
+                                                       index.starts[verse + 1]):
+            matches.add(verse)
+    return matches
+
+
+def _find_runs(verse_runs, runs, case_sensitive=False):
+    matchers = [_get_token_matcher(run, case_sensitive) for run in runs]
+    return [i for i in range(len(verse_runs) - len(runs) + 1)
+            if all(match(verse_runs[i + j]) for j, match in enumerate(matchers))]
+
+
+def match_phrase(verse, words, case_sensitive=False):
+    # Checks the text of a verse, for indexes without positions and case sensitive searches
+    runs = list(chain.from_iterable(map(RUN.findall, words)))
+    return bool(_find_runs(get_runs(verse), runs, case_sensitive))
+
+
+def match_near(verse, first, second, distance, case_sensitive=False):
+    # Checks the text of a verse, for indexes without positions
+    verse_runs = get_runs(verse)
+    positions = _find_runs(verse_runs, RUN.findall(first), case_sensitive)
+    positions2 = _find_runs(verse_runs, RUN.findall(second), case_sensitive)
+    return any(0 < abs(i - j) <= distance for i in positions for j in positions2)
+
+
+def find_term(index, word, exact=False, case_sensitive=False):
+    # Returns a dictionary of the index and the ids of its terms that match word
+    match = STRONGS.fullmatch(word)
+    if match:  # Looked up in the lemmas of tagged Bibles
+        if index.lemmas is None:
+            return index.terms, []
+        i = index.lemmas.find(match.group(1).upper() + match.group(2))
+        return index.lemmas, [i] if i != -1 else []
+    if WILDCARD in word or not exact or len(word) == 1 and has_cjk(word):  # Part of bigrams
+        return expand_term(index, word, case_sensitive)
+    dictionary = index.terms if case_sensitive else index.folded
+    i = dictionary.find(word if case_sensitive else fold(word))
+    return dictionary, [i] if i != -1 else []
+
+
+def get_postings(dictionary, ids):
+    if len(ids) == 1:
+        return dictionary.get_values(ids[0])
+    return from_bitmap(get_bitmap(dictionary, ids))
+
+
+def get_bitmap(dictionary, ids):
+    # Returns the verse bitmap of the verses that contain any of the terms of ids
+    return to_bitmap(chain.from_iterable(dictionary.get_values(i) for i in ids))
+
+
+def plan_terms(index, words, exact=False, case_sensitive=False):
+    # Orders terms by the encoded size of their postings, which is cheaper than decoding them
+    # to count verses and grows with it
+    terms = []
+    for word in words:
+        dictionary, ids = find_term(index, word, exact, case_sensitive)
+        terms.append((sum(dictionary.get_size(i) for i in ids), dictionary, ids))
+    terms.sort(key=lambda term: term[0])
+    return terms
+
+
+def _gallop(values, value, low):
+    # Returns the first index from low on where values[index] >= value
+    high = low
+    step = 1
+    while high < len(values) and values[high] < value:
+        low = high + 1
+        high += step
+        step *= 2
+    return bisect_left(values, value, low, min(high, len(values)))
+
+
+def intersect(postings, postings2):
+    if len(postings) > len(postings2):
+        postings, postings2 = postings2, postings
+    matches = []
+    i = 0
+    for value in postings:
+        i = _gallop(postings2, value, i)
+        if i == len(postings2):
+            break
+        elif postings2[i] == value:
+            matches.append(value)
+    return matches
+
+
+def find_all_bitmap(index, words, exact=False, case_sensitive=False):
+    # Returns the verse bitmap of verses that contain all of words, rarest first. CJK words are
+    # found by all of their bigrams, which still need to be checked to be next to each other.
+    words = [word2 for word in words for word2 in split_cjk(word) if word2.strip(WILDCARD)]
+    matches = None
+    for size, dictionary, ids in plan_terms(index, words, exact, case_sensitive):
+        if not ids:
+            return 0
+        bitmap = get_bitmap(dictionary, ids)
+        matches = bitmap if matches is None else matches & bitmap
+        if not matches:
+            return 0
+    return matches or 0
+
+
+def find_all(index, words, exact=False, case_sensitive=False):
+    return from_bitmap(find_all_bitmap(index, words, exact, case_sensitive))
+
+
+def find_word_bitmap(index, word, exact=False, case_sensitive=False):
+    # Returns the verse bitmap of verses that contain word, or all of its bigrams if it is CJK
+    if has_cjk(word):
+        return find_all_bitmap(index, [word], exact, case_sensitive)
+    return get_bitmap(*find_term(index, word, exact, case_sensitive))
+
+
+def find_word(index, word, exact=False, case_sensitive=False):
+    # Returns the ordinals of verses that contain word, or all of its bigrams if it is CJK
+    if has_cjk(word):
+        return find_all(index, [word], exact, case_sensitive)
+    dictionary, ids = find_term(index, word, exact, case_sensitive)
+    if not ids:
+        return []
+    return get_postings(dictionary, ids)
+
+
+def edit_distance(word, word2, limit):
+    # Returns the number of insertions, deletions, substitutions and transpositions of adjacent
+    # characters that turn word into word2, or limit + 1 if it is more than limit
+    if abs(len(word) - len(word2)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(word2) + 1))
+    for i, char in enumerate(word, 1):
+        row = [i]
+        for j, char2 in enumerate(word2, 1):
+            distance = min(previous[j] + 1, row[j - 1] + 1, previous[j - 1] + (char != char2))
+            if i > 1 and j > 1 and char == word2[j - 2] and word[i - 2] == char2:
+                distance = min(distance, previous2[j - 2] + 1)
+            row.append(distance)
+        if min(row) > limit:
+            return limit + 1
+        previous2, previous = previous, row
+    return min(previous[-1], limit + 1)
+
+
+def get_surface_form(index, i):
+    # Returns the most common spelling of a folded term, e.g., "Jesus" for "jesus"
+    ids = index.variants.get_values(i)
+    return index.terms.get_key(max(ids, key=index.terms.get_size))
+
+
+def suggest_terms(index, word, limit=5):
+    # Returns (distance, verse count, term) of the terms that are spelled most like word. The
+    # candidates are the terms that share the most n-grams with it in the grams dictionary.
+    folded = fold(word)
+    max_distance = 1 if len(folded) <= 4 else 2
+    counts = Counter()
+    for gram in get_grams("^%s$" % folded):
+        if len(gram) > 1:
+            counts.update(index.grams.get(gram, ()))
+    suggestions = []
+    for i in heapq.nlargest(SUGGESTION_CANDIDATES, counts, key=counts.get):
+        term = index.folded.get_key(i)
+        distance = edit_distance(folded, term, max_distance)
+        if 0 < distance <= max_distance:
+            suggestions.append((distance, -len(index.folded.get_values(i)), i))
+    return [(distance, -count, get_surface_form(index, i))
+            for distance, count, i in sorted(suggestions)[:limit]]
+
+
+def suggest(index, text, limit=5):
+    # Returns queries like text with its words that are not in the index respelled, most likely
+    # first. Words that are operators, Strong's numbers or wildcards are kept as they are.
+    words = unify_quotes(text).split()
+    choices = []
+    for word in words:
+        term = fold(re.sub(r"[^\w'\-%s]" % MARKS, r"", word))
+        if (NEAR.match(word) or STRONGS.fullmatch(word) or WILDCARD in word or has_cjk(word) or
+                not term or term in index.folded):
+            choices.append([(0, 0, word)])
+        else:
+            choices.append(suggest_terms(index, term, limit) or [(0, 0, word)])
+    if all(len(word_choices) == 1 and word_choices[0][0] == 0 for word_choices in choices):
+        return []
+    # The scores add up, so only the best partial queries can lead to the best queries
+    queries = [(0, 0, ())]
+    for word_choices in choices:
+        queries = heapq.nsmallest(limit, ((distance + choice[0], count - choice[1], words +
+                                           (choice[2],))
+                                          for distance, count, words in queries
+                                          for choice in word_choices))
+    return [" ".join(words) for distance, count, words in queries]
+
+
+# Regular expressions are prefiltered with the trigrams index, like Google Code Search. Each part
+# of a pattern is analyzed into (exact, prefix, suffix, query): the set of strings it can match
+# if that is known and small, otherwise sets of strings that all of its matches start and end
+# with, and a query of trigrams that verses matching it must contain. Queries are None (every
+# verse), a trigram, or ("and", queries) or ("or", queries).
+
+def _and(*queries):
+    queries = [query for query in queries if query is not None]
+    if not queries:
+        return None
+    return queries[0] if len(queries) == 1 else ("and", tuple(queries))
+
+
+def _or(*queries):
+    if None in queries:
+        return None
+    return queries[0] if len(queries) == 1 else ("or", tuple(queries))
+
+
+def _strings_query(strings):
+    if len(strings) > MAX_STRINGS * MAX_STRINGS:
+        return None
+    return _or(*[_and(*[string[i:i + 3] for i in range(len(string) - 2)])
+                 for string in strings])
+
+
+def _cross(strings, strings2):
+    return {string + string2 for string in strings for string2 in strings2}
+
+
+def _trim(strings, prefix):
+    # Shortens the prefixes (or suffixes) that matches start (or end) with until there are few
+    # enough of them, which weakens the analysis but keeps it correct
+    if len(strings) > MAX_STRINGS:
+        strings = {string[:2] if prefix else string[-2:] for string in strings}
+    return strings if len(strings) <= MAX_STRINGS else {""}
+
+
+def _inexact(info):
+    exact, prefix, suffix, query = info
+    if exact is None:
+        return info
+    return (None, exact, exact, _and(query, _strings_query(exact)))
+
+
+_ANY = (None, {""}, {""}, None)
+_EMPTY = ({""}, None, None, None)
+
+
+def _concat(info, info2):
+    exact, prefix, suffix, query = info
+    exact2, prefix2, suffix2, query2 = info2
+    if exact is not None and exact2 is not None and len(exact) * len(exact2) <= MAX_STRINGS:
+        return (_cross(exact, exact2), None, None, _and(query, query2))
+    suffix = exact if exact is not None else suffix
+    prefix2 = exact2 if exact2 is not None else prefix2
+    return (None,
+            _trim(_cross(exact, prefix2), True) if exact is not None else prefix,
+            _trim(_cross(suffix, exact2), False) if exact2 is not None else suffix2,
+            _and(query, query2, _strings_query(_cross(suffix, prefix2))))
+
+
+def _alternate(info, info2):
+    if info[0] is not None and info2[0] is not None and len(info[0] | info2[0]) <= MAX_STRINGS:
+        return (info[0] | info2[0], None, None, _or(info[3], info2[3]))
+    exact, prefix, suffix, query = _inexact(info)
+    exact2, prefix2, suffix2, query2 = _inexact(info2)
+    return (None, _trim(prefix | prefix2, True), _trim(suffix | suffix2, False),
+            _or(query, query2))
+
+
+def _analyze_class(items):
+    chars = set()
+    for op, value in items:
+        if op is sre_constants.LITERAL:
+            chars.add(chr(value))
+        elif op is sre_constants.RANGE and value[1] - value[0] < MAX_CLASS:
+            chars.update(map(chr, range(value[0], value[1] + 1)))
+        else:
+            return _ANY
+    if len(chars) > MAX_CLASS:
+        return _ANY
+    return ({fold_case(char) for char in chars}, None, None, None)
+
+
+def _analyze_repeat(low, high, items):
+    info = _analyze(items)
+    if info[0] is not None and low == high <= MAX_STRINGS:
+        result = _EMPTY
+        for i in range(low):
+            result = _concat(result, info)
+        return result
+    if low == 0:
+        return _alternate(_EMPTY, info) if high == 1 else _ANY
+    exact, prefix, suffix, query = _inexact(info)
+    return (None, prefix, suffix, query)
+
+
+def _analyze(items):
+    result = _EMPTY
+    for op, value in items:
+        if op is sre_constants.LITERAL:
+            info = ({fold_case(chr(value))}, None, None, None)
+        elif op is sre_constants.IN:
+            info = _analyze_class(value)
+        elif op is sre_constants.BRANCH:
+            info = _analyze(value[1][0])
+            for branch in value[1][1:]:
+                info = _alternate(info, _analyze(branch))
+        elif op is sre_constants.SUBPATTERN:
+            info = _analyze(value[-1])
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT,
+                    getattr(sre_constants, "POSSESSIVE_REPEAT", None)):
+            info = _analyze_repeat(*value)
+        elif op in (sre_constants.AT, sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            info = _EMPTY  # Anchors and lookarounds do not consume text
+        else:
+            info = _ANY
+        result = _concat(result, info)
+    return result
+
+
+def get_trigram_query(pattern):
+    # Returns a query of the trigrams that verses must contain to match a compiled pattern
+    exact, prefix, suffix, query = _analyze(sre_parse.parse(pattern.pattern, pattern.flags))
+    if exact is not None:
+        return _and(query, _strings_query(exact))
+    return _and(query, _strings_query(prefix), _strings_query(suffix))
+
+
+def _get_query_size(index, query):
+    # Trigrams with the fewest verses are intersected first, and then subqueries
+    if not isinstance(query, str):
+        return float("inf")
+    i = index.trigrams.find(query)
+    return index.trigrams.get_size(i) if i != -1 else 0
+
+
+def _get_trigram_bitmap(index, query, bitmaps):
+    if isinstance(query, str):
+        if query not in bitmaps:
+            i = index.trigrams.find(query)
+            bitmaps[query] = index.trigrams.get_bitmap(i) if i != -1 else 0
+        return bitmaps[query]
+    op, queries = query
+    if op == "or":
+        result = 0
+        for query2 in queries:
+            result |= _get_trigram_bitmap(index, query2, bitmaps)
+        return result
+    result = None
+    for query2 in sorted(queries, key=lambda query2: _get_query_size(index, query2)):
+        if result is not None and bin(result).count("1") <= ENOUGH_CANDIDATES:
+            break  # The rest would be checked by the pattern anyway
+        bitmap = _get_trigram_bitmap(index, query2, bitmaps)
+        result = bitmap if result is None else result & bitmap
+    return result
+
+
+def find_pattern(index, pattern):
+    # Returns the verse bitmap of the verses that may match a compiled pattern, or None if it
+    # cannot be narrowed down and every verse must be scanned
+    if index is None or index.trigrams is None:
+        return None
+    query = get_trigram_query(pattern)
+    if query is None:
+        return None
+    return _get_trigram_bitmap(index, query, {})
+
+
+def get_flags(options):
+    return re.UNICODE if options["CaseSensitive"] else re.UNICODE | re.IGNORECASE
+
+
+def parse_query(text):
+    # Returns the words of a search and its NEAR/n operators, as returned by parse_near
+    words = [word if STRONGS.fullmatch(word) else re.sub(r"[^\w'\-*/%s]" % MARKS, r"", word)
+             for word in unify_quotes(text).split()]
+    words = [word if NEAR.match(word) else word.replace("/", "") for word in words]
+    return parse_near([word for word in words if word.strip(WILDCARD)])
+
+
+def get_pattern(words, links, options):
+    # Returns the pattern that highlights matches of words in verse text
+    patterns = [term_pattern(word, options["CaseSensitive"]) for word in words]
+    if links:
+        pattern = r"%s(%s)%s" % (WORD_START, "|".join(patterns), WORD_END)
+    elif options["Phrase"]:
+        pattern = WORD_START + r"\W+".join(patterns) + WORD_END
+    else:
+        if options["ExactMatch"]:
+            patterns = [WORD_START + pattern + WORD_END for pattern in patterns]
+        pattern = r"(%s)" % "|".join(patterns)
+    return re.compile(pattern, get_flags(options))
+
+
+def check_bigrams(Bible, matches, words, options):
+    # CJK words are found by their bigrams, which may not be next to each other in a verse
+    patterns = [re.compile(term_pattern(word, options["CaseSensitive"]), get_flags(options))
+                for word in words if len(split_cjk(word)) > 1]
+    if not patterns:
+        return matches
+    return [item for item in matches
+            if all(pattern.search(Bible.get_slot(item)) for pattern in patterns)]
+
+
+def _find_runs_bitmap(index, words, verses, case_sensitive=False):
+    # Returns the verses of verses with terms that contain every run of words. These include
+    # every verse where they are runs of their own, even in terms like "Lord's".
+    for run in chain.from_iterable(map(RUN.findall, words)):
+        if not verses:
+            break
+        elif has_cjk(run):
+            verses &= find_word_bitmap(index, run, False, case_sensitive)
+        else:
+            verses &= get_bitmap(*expand_term(index, "%s%s%s" % (WILDCARD, run, WILDCARD),
+                                              case_sensitive))
+    return verses
+
+
+def check_phrase(index, Bible, words, verses, case_sensitive=False):
+    # Returns the verse bitmap of the verses in verses where the runs of words are next to each
+    # other. Indexes with and without positions match runs the same way, so that they find the
+    # same verses.
+    if index.positions is not None:
+        verses &= to_bitmap(find_phrase(index, words))
+        if not case_sensitive:
+            return verses
+    else:
+        verses = _find_runs_bitmap(index, words, verses, case_sensitive)
+    return to_bitmap(item for item in from_bitmap(verses)
+                     if match_phrase(Bible.get_slot(item), words, case_sensitive))
+
+
+def check_near(index, Bible, first, second, distance, verses, case_sensitive=False):
+    # Returns the verse bitmap of the verses in verses where the runs of two words are at most
+    # distance runs apart, matched the same way as by check_phrase
+    if index.positions is not None:
+        verses &= to_bitmap(find_near(index, first, second, distance))
+        if not case_sensitive:
+            return verses
+    else:
+        verses = _find_runs_bitmap(index, [first, second], verses, case_sensitive)
+    return to_bitmap(item for item in from_bitmap(verses)
+                     if match_near(Bible.get_slot(item), first, second, distance,
+                                   case_sensitive))
+
+
+def _search_near(index, Bible, words, links, verses, case_sensitive=False):
+    linked = {i for first, second, distance in links for i in (first, second)}
+    for i, word in enumerate(words):
+        if i not in linked:
+            verses = check_phrase(index, Bible, [word], verses, case_sensitive)
+    for first, second, distance in links:
+        verses = check_near(index, Bible, words[first], words[second], distance, verses,
+                            case_sensitive)
+    return from_bitmap(verses)
+
+
+def search_index(index, Bible, words, links, options, start=0, stop=VERSE_COUNT):
+    # Returns the ordinals of the verses from start to stop that match words. Sets of verses are
+    # combined as verse bitmaps, starting from the range, so that verses outside of it are never
+    # read and every word-level operation also deduplicates.
+    exact = options["ExactMatch"]
+    case_sensitive = options["CaseSensitive"]
+    verses = get_range_bitmap(start, stop)
+    if links:
+        return _search_near(index, Bible, words, links, verses, case_sensitive)
+    elif options["Phrase"]:
+        return from_bitmap(check_phrase(index, Bible, words, verses, case_sensitive))
+    elif options["AllWords"]:
+        return check_bigrams(Bible, from_bitmap(
+            verses & find_all_bitmap(index, words, exact, case_sensitive)), words, options)
+    matches = 0
+    for word in words:
+        word_matches = verses & find_word_bitmap(index, word, exact, case_sensitive)
+        if len(split_cjk(word)) > 1:  # Its bigrams have to be checked in the verse text
+            word_matches = to_bitmap(check_bigrams(Bible, from_bitmap(word_matches), [word],
+                                                   options))
+        matches |= word_matches
+    return from_bitmap(matches)
+
+
+def refine(index, previous, words, links, options):
+    # Returns the verses that match words by narrowing down the matches of a previous search,
+    # or None if they cannot be found that way. Both searches have to look for all of their
+    # words, and words may only add to the previous ones or lengthen the last of them, which
+    # then matches some of the terms it did before. This is what typing a search does.
+    words2, links2, options2, matches = previous
+    if (links or links2 or options != options2 or not options["AllWords"] or
+            options["Phrase"] or options["ExactMatch"] or options["RegularExpression"] or
+            not words2 or len(words) < len(words2)):
+        return None
+    last = len(words2) - 1
+    if words[:last] != words2[:last] or any(WILDCARD in word or STRONGS.fullmatch(word) or
+                                            has_cjk(word) for word in words[last:]):
+        return None
+    case_sensitive = options["CaseSensitive"]
+    if case_sensitive:
+        if words2[last] not in words[last]:
+            return None
+    elif fold(words2[last]) not in fold(words[last]):
+        return None
+    for word in words[last + (words[last] == words2[last]):]:
+        if not matches:
+            break
+        matches = intersect(matches, find_word(index, word, False, case_sensitive))
+    return list(matches)
+
+
+class QueryNode:
+    # A node of a boolean query. Planning estimates how many verses it matches and puts the
+    # operands of AND in the order they are run in, and running it records how many verses it
+    # found and how long that took.
+    def __init__(self, op, children=(), value=None):
+        self.op = op  # "and", "or", "not", "near", "term", "phrase" or "book"
+        self.children = list(children)
+        self.value = value  # Word, words of a phrase, NEAR distance or (start, stop, label)
+        self.estimate = None
+        self.method = None  # How a phrase, NEAR or CJK word was checked
+        self.count = None  # Verses found, or None if the node was skipped
+        self.msec = None
+
+
+def _tokenize_query(text):
+    tokens = []
+    for match in QUERY_TOKEN.finditer(unify_quotes(text)):
+        paren, phrase, field, value, word = match.groups()
+        if field is not None:
+            if field.lower() == "strong":  # Strong's numbers are words
+                word = "%s:%s" % (field, value)
+            else:
+                tokens.append(("field", (field.lower(), value.strip('"'))))
+        if paren:
+            tokens.append((paren, None))
+        elif phrase is not None:
+            words = parse_query(phrase)[0]
+            if words:
+                tokens.append(("phrase", words))
+        elif word in OPERATORS:
+            tokens.append((word, None))
+        elif word and NEAR.match(word):
+            tokens.append(("NEAR", int(NEAR.match(word).group(1))))
+        elif word:
+            tokens.extend(("word", word2) for word2 in parse_query(word)[0])
+    return tokens
+
+
+def _parse_field(name, value):
+    if name != "book":
+        raise ValueError("unknown field %s:" % name)
+    elif not value:
+        raise ValueError("missing book after book:")
+    books = []
+    for abbrev in value.split("-", 1):
+        book = get_book_index(abbrev.replace("_", " "), True)
+        if book == -1:
+            raise ValueError("unknown book %s" % abbrev)
+        books.append(book)
+    first, last = min(books), max(books)
+    label = BOOK_NAMES[first - 1] if first == last else "%s - %s" % (BOOK_NAMES[first - 1],
+                                                                     BOOK_NAMES[last - 1])
+    return QueryNode("book", value=(BOOK_VERSE_OFFSETS[first - 1], BOOK_VERSE_OFFSETS[last],
+                                    label))
+
+
+def _parse_operand(tokens, i):
+    if i == len(tokens):
+        raise ValueError("missing search term at the end")
+    kind, value = tokens[i]
+    if kind == "NOT":
+        node, i = _parse_operand(tokens, i + 1)
+        return QueryNode("not", [node]), i
+    elif kind == "(":
+        node, i = _parse_or(tokens, i + 1)
+        if i == len(tokens):
+            raise ValueError("missing closing parenthesis")
+        return node, i + 1
+    elif kind == "word":
+        return QueryNode("term", value=value), i + 1
+    elif kind == "phrase":
+        return QueryNode("phrase", value=value), i + 1
+    elif kind == "field":
+        return _parse_field(*value), i + 1
+    raise ValueError("missing search term before %s" % (kind if kind != "NEAR" else
+                                                         "NEAR/%d" % value))
+
+
+def _parse_and(tokens, i):
+    # Operands next to each other are joined by AND, which binds tighter than OR
+    children = []
+    while i < len(tokens) and tokens[i][0] not in ("OR", ")"):
+        kind, value = tokens[i]
+        if kind == "AND" and children:
+            i += 1
+            if i == len(tokens) or tokens[i][0] in ("AND", "OR", ")"):
+                raise ValueError("missing search term after AND")
+            continue
+        elif kind == "NEAR" and children and children[-1].op == "term":
+            node, i = _parse_operand(tokens, i + 1)
+            if node.op != "term":
+                raise ValueError("NEAR/%d has to be between two words" % value)
+            children[-1] = QueryNode("near", [children[-1], node], value)
+            continue
+        node, i = _parse_operand(tokens, i)
+        children.append(node)
+    if not children:
+        raise ValueError("missing search term" if i == len(tokens) else
+                         "missing search term before %s" % tokens[i][0])
+    return children[0] if len(children) == 1 else QueryNode("and", children), i
+
+
+def _parse_or(tokens, i):
+    node, i = _parse_and(tokens, i)
+    children = [node]
+    while i < len(tokens) and tokens[i][0] == "OR":
+        node, i = _parse_and(tokens, i + 1)
+        children.append(node)
+    return children[0] if len(children) == 1 else QueryNode("or", children), i
+
+
+def parse_boolean(text):
+    # Returns the tree of QueryNodes of a boolean query, or None if text has no AND, OR or NOT,
+    # parentheses, quotes or book: and is searched as words. Raises ValueError if it is invalid.
+    if not BOOLEAN.search(unify_quotes(text)):
+        return None
+    tokens = _tokenize_query(text)
+    node, i = _parse_or(tokens, 0)
+    if i < len(tokens):
+        raise ValueError("unexpected closing parenthesis")
+    return node
+
+
+def get_query_words(node):
+    # Returns the words that a boolean query looks for, to be highlighted, which leaves out the
+    # words after NOT
+    if node.op == "term":
+        return [node.value]
+    elif node.op == "phrase":
+        return list(node.value)
+    elif node.op == "not":
+        return []
+    return list(chain.from_iterable(map(get_query_words, node.children)))
+
+
+def plan_query(index, node, options):
+    # Estimates how many verses each node matches from the encoded size of postings lists, as
+    # plan_terms does, and orders the operands of AND from the fewest verses up so that the
+    # verses left to check shrink as fast as possible. NOT comes last, and only removes verses.
+    node.count = node.msec = node.method = None
+    op = node.op
+    case_sensitive = options["CaseSensitive"]
+    if op in ("term", "phrase"):
+        words = [node.value] if op == "term" else node.value
+        exact = op == "phrase" or options["ExactMatch"]
+        words = [word2 for word in words for word2 in split_cjk(word) if word2.strip(WILDCARD)]
+        terms = plan_terms(index, words, exact, case_sensitive)
+        node.estimate = min(terms[0][0], VERSE_COUNT) if terms else 0
+    elif op == "book":
+        node.estimate = node.value[1] - node.value[0]
+    else:
+        for child in node.children:
+            plan_query(index, child, options)
+        estimates = [child.estimate for child in node.children]
+        if op == "not":
+            node.estimate = max(0, VERSE_COUNT - estimates[0])
+        elif op == "or":
+            node.estimate = min(VERSE_COUNT, sum(estimates))
+        elif op == "near":
+            node.estimate = min(estimates)
+        else:
+            node.children.sort(key=lambda child: (child.op == "not", child.estimate))
+            node.estimate = min([child.estimate for child in node.children
+                                 if child.op != "not"] or [VERSE_COUNT])
+    return node
+
+
+def run_plan(index, Bible, node, options, verses):
+    # Returns the verse bitmap of the verses in verses that match a planned node. Each operand
+    # of AND is only looked for in the verses that the ones before it left, and the rest are
+    # skipped once none are left.
+    sec = time.perf_counter()
+    op = node.op
+    exact = options["ExactMatch"]
+    case_sensitive = options["CaseSensitive"]
+    if op == "and":
+        for child in node.children:
+            if not verses:
+                break
+            verses = run_plan(index, Bible, child, options, verses)
+    elif op == "or":
+        found = 0
+        for child in node.children:
+            found |= run_plan(index, Bible, child, options, verses)
+        verses = found
+    elif op == "not":
+        verses &= ~run_plan(index, Bible, node.children[0], options, verses)
+    elif op == "book":
+        verses &= get_range_bitmap(*node.value[:2])
+    elif op == "term":
+        verses &= find_word_bitmap(index, node.value, exact, case_sensitive)
+        if verses and len(split_cjk(node.value)) > 1:
+            node.method = "bigrams checked in verse text"
+            verses = to_bitmap(check_bigrams(Bible, from_bitmap(verses), [node.value], options))
+    elif op in ("phrase", "near"):
+        node.method = "positions" if index.positions is not None and not case_sensitive else \
+            "verse text"
+        if op == "phrase":
+            verses = check_phrase(index, Bible, node.value, verses, case_sensitive)
+        else:
+            first, second = [child.value for child in node.children]
+            verses = check_near(index, Bible, first, second, node.value, verses,
+                                case_sensitive)
+    node.count = bin(verses).count("1")
+    node.msec = (time.perf_counter() - sec) * 1000
+    return verses
+
+
+def search_boolean(index, Bible, node, options, start=0, stop=VERSE_COUNT):
+    # Returns the ordinals of the verses from start to stop that match a boolean query. Only
+    # verses that the Bible has are searched, so that NOT leaves out the ones it is missing.
+    plan_query(index, node, options)
+    return from_bitmap(run_plan(index, Bible, node, options,
+                                get_range_bitmap(start, stop) & Bible.get_verse_bitmap()))
+
+
+def format_plan(node, depth=0):
+    # Returns lines that show how a boolean query was run, one per node
+    if node.op == "term":
+        label = "word \"%s\"" % node.value
+    elif node.op == "phrase":
+        label = "phrase \"%s\"" % " ".join(node.value)
+    elif node.op == "near":
+        label = "NEAR/%d" % node.value
+    elif node.op == "book":
+        label = "book %s" % node.value[2]
+    else:
+        label = node.op.upper()
+    if node.method:
+        label += " (%s)" % node.method
+    if node.count is None:
+        result = "skipped"
+    else:
+        result = "%d verses in %.2f msec" % (node.count, node.msec)
+    lines = ["%s%s: about %d verses, %s" % ("    " * depth, label, node.estimate, result)]
+    if node.op != "near":
+        for child in node.children:
+            lines.extend(format_plan(child, depth + 1))
+    return lines
+
+
+def get_scan_ordinals(pattern, start=0, stop=VERSE_COUNT, index=None):
+    # Returns the ordinals of the verses from start to stop that a regular expression has to be
+    # checked against. If an index is given, only the verses that contain its trigrams are.
+    verses = find_pattern(index, pattern)
+    if verses is None:
+        return range(start, stop)
+    return from_bitmap(verses & get_range_bitmap(start, stop))
+
+
+def _scan(Bible, pattern, ordinals):
+    return [ordinal for ordinal in ordinals
+            if pattern.search(Bible.get_slot(ordinal).replace("[", "").replace("]", ""))]
+
+
+def scan(Bible, pattern, start=0, stop=VERSE_COUNT, index=None):
+    # Returns the ordinals of the verses from start to stop whose text matches a regular expression
+    return _scan(Bible, pattern, get_scan_ordinals(pattern, start, stop, index))
+
+
+def get_scan_tasks(bible_file, pattern, ordinals):
+    # Splits a scan into one task for scan_book per book, so that a process pool can share it out
+    # and the books that were finished can be shown if it is stopped
+    tasks = []
+    for b in range(1, len(BOOK_VERSE_OFFSETS)):
+        if isinstance(ordinals, range):
+            book_ordinals = range(max(ordinals.start, BOOK_VERSE_OFFSETS[b - 1]),
+                                  min(ordinals.stop, BOOK_VERSE_OFFSETS[b]))
+        else:
+            book_ordinals = ordinals[bisect_left(ordinals, BOOK_VERSE_OFFSETS[b - 1]):
+                                     bisect_left(ordinals, BOOK_VERSE_OFFSETS[b])]
+        if book_ordinals:
+            tasks.append((bible_file, pattern.pattern, pattern.flags, book_ordinals))
+    return tasks
+
+
+def scan_book(args):
+    # Returns the ordinals of a task from get_scan_tasks that match its regular expression, for
+    # process pools
+    bible_file, text, flags, ordinals = args
+    Bible = open_bible(bible_file)
+    try:
+        return _scan(Bible, re.compile(text, flags), ordinals)
+    finally:
+        Bible.close()
+
+
+def search_version(args):
+    # Searches the Bible and index files of a version, for process pools. Returns None if the
+    # index is missing or out of date, so that the caller can rebuild it.
+    bible_file, index_file, text, options, start, stop = args
+    Bible = open_bible(bible_file)
+    try:
+        try:
+            index = open_index(index_file)
+        except (IOError, ValueError):
+            index = None
+        if index is not None and index.fingerprint != get_fingerprint(Bible):
+            index.close()
+            index = None
+        try:
+            if options["RegularExpression"]:  # Scans every verse if there is no index
+                return scan(Bible, re.compile(text, get_flags(options)), start, stop, index)
+            if index is None:
+                return None
+            node = parse_boolean(text)
+            if node is not None:
+                return search_boolean(index, Bible, node, options, start, stop)
+            return search_index(index, Bible, *parse_query(text), options, start, stop)
+        finally:
+            if index is not None:
+                index.close()
+    finally:
+        Bible.close()
+
+
+def get_cache_key(text, options, start=0, stop=VERSE_COUNT):
+    # Searches that differ only in spacing or curly quotes find the same verses, except regular
+    # expressions, in which spacing is part of the pattern
+    text = unify_quotes(text)
+    if not options["RegularExpression"]:
+        text = " ".join(text.split())
+    return (text,) + tuple(options[option] for option in sorted(options)) + (start, stop)
+
+
+class ResultCache:
+    # Keeps the ordinals found by recent searches by version and cache key, and forgets them when
+    # the fingerprint of their version changes. If a filename is given, the most recent results
+    # of each version are also saved there, so that they last between sessions.
+    def __init__(self, max_size, filename=None, max_saved=256):
+        self.max_size = max_size
+        self.max_saved = max_saved
+        self._filename = filename
+        self._results = OrderedDict()  # (Version, key): (fingerprint, ordinals)
+        self._size = 0
+        self._saved = {}  # Version: (fingerprint, {key: encoded ordinals})
+        self._modified = False
+        self._lock = threading.Lock()  # Searches run on background threads
+        if filename is not None and os.path.isfile(filename):
+            try:
+                with open(filename, 'rb') as fileobj:
+                    self._saved = pickle.load(fileobj)
+            except (EOFError, pickle.UnpicklingError):
+                pass
+
+    def get(self, version, key, fingerprint):
+        with self._lock:
+            result = self._results.get((version, key))
+            if result is not None and result[0] == fingerprint:
+                self._results.move_to_end((version, key))
+                return result[1]
+            saved = self._saved.get(version)
+            if saved is None or saved[0] != fingerprint or key not in saved[1]:
+                return None
+            ordinals = decode_deltas(saved[1][key])
+            self._add(version, key, fingerprint, ordinals)
+            return ordinals
+
+    def add(self, version, key, fingerprint, ordinals, save=True):
+        ordinals = array("I", ordinals)
+        with self._lock:
+            self._add(version, key, fingerprint, ordinals)
+            if self._filename is None or not save:
+                return
+            saved = self._saved.get(version)
+            if saved is None or saved[0] != fingerprint:
+                saved = self._saved[version] = (fingerprint, OrderedDict())
+            saved[1][key] = bytes(encode_deltas(ordinals))
+            saved[1].move_to_end(key)
+            while len(saved[1]) > self.max_saved:
+                saved[1].popitem(False)
+            self._modified = True
+
+    def _add(self, version, key, fingerprint, ordinals):
+        result = self._results.pop((version, key), None)
+        if result is not None:
+            self._size -= len(result[1]) * result[1].itemsize
+        self._results[(version, key)] = (fingerprint, ordinals)
+        self._size += len(ordinals) * ordinals.itemsize
+        while self._size > self.max_size and len(self._results) > 1:
+            result = self._results.popitem(False)[1]
+            self._size -= len(result[1]) * result[1].itemsize
+
+    def prune(self, versions):
+        with self._lock:
+            for version in [version for version in self._saved if version not in versions]:
+                del self._saved[version]
+                self._modified = True
+
+    def save(self):
+        with self._lock:
+            if self._modified:
+                with open(self._filename, 'wb') as fileobj:
+                    pickle.dump(self._saved, fileobj, -1)
+                self._modified = False
@@ -1,13 +1,13 @@
 """html2.py - HTML related classes"""
 
 import os.path
-import pickle
 import webbrowser
 
 import wx
 import wx.lib.dragscroller
 from wx import html
 
+from bible import open_bible, upgrade_bible
 from constants import BOOK_NAMES, BOOK_LENGTHS
 
 _ = wx.GetTranslation
@@ -136,16 +136,19 @@ class ChapterWindow(ChapterWindowBase):
         if not os.path.isfile(filename):
             filename = os.path.join(self._frame._app.version_dir, "%s.bbl" % version)
         try:
-            with open(filename, 'rb') as fileobj:
-                metadata = pickle.load(fileobj)
-                self.Bible = pickle.load(fileobj)
-                self.Bible[0] = metadata
-        except IOError as exc:
+            try:
+                upgrade_bible(filename)
+            except OSError:  # Bibles that cannot be written stay in the older format
+                pass
+            metadata = self._frame.catalog.get_metadata(filename)
+            self.Bible = open_bible(filename)
+            self.filename = filename
+        except (IOError, ValueError) as exc:
             wx.MessageBox(_("Could not load %s.\n\nError: %s") % (version, exc), _("Error"),
                           wx.ICON_WARNING | wx.OK)
         else:
-            self.description = self.Bible[0]["description"]
-            self.flag_name = self.Bible[0]["lang"].split("-")[0]
+            self.description = metadata["description"]
+            self.flag_name = metadata["lang"].split("-")[0]
 
     def get_html(self, book, chapter, verse=-1):
         if self.Bible[book] and self.Bible[book][chapter]:
@@ -0,0 +1,595 @@
+"""index.py - search index reading and writing"""
+
+import glob
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+import sys
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from itertools import accumulate, compress
+
+from bible import open_bible, pack_uint32, unpack_uint32
+from constants import BOOK_VERSE_OFFSETS, VERSE_COUNT
+
+MAGIC = b"BRIX"
+FORMAT_VERSION = 4
+FLAG_POSITIONS = 0x1
+
+# Magic, format version, flags and section count, followed by the section table
+HEADER = struct.Struct("<4sHHI")
+# Section name, offset and length
+SECTION = struct.Struct("<16sQQ")
+# Index format version, tokenizer version and checksum of the Bible that was indexed
+FINGERPRINT = struct.Struct("<HH20s")
+
+# Increment this when changes to tokenizing would give different index contents
+TOKENIZER_VERSION = 3
+
+# Terms are split into n-grams of up to this length, with ^ and $ marking their boundaries
+GRAM_SIZE = 3
+
+# Verse bitmaps with up to this many verses are decoded by finding each bit
+SPARSE_BITMAP = 3000
+
+
+def _get_class(chars):
+    # Returns the contents of a regular expression character set that matches chars
+    ranges = []
+    for char in map(ord, chars):
+        if ranges and ranges[-1][1] == char - 1:
+            ranges[-1][1] = char
+        else:
+            ranges.append([char, char])
+    return "".join(chr(start) if start == stop else "%s-%s" % (chr(start), chr(stop))
+                   for start, stop in ranges)
+
+
+# Combining marks are not word characters for re, but are part of the words they follow
+_MARKS = [chr(i) for i in range(0x20000) if unicodedata.category(chr(i)).startswith("M")]
+MARKS = _get_class(_MARKS)
+# Accents, breathings, vowel points and cantillation, which searches ignore
+_DIACRITICS = [mark for mark in _MARKS if unicodedata.combining(mark)]
+DIACRITICS = _get_class(_DIACRITICS)
+QUOTES = "\u2018\u2019\u02bc"  # Unified with apostrophes
+_QUOTES = str.maketrans(QUOTES, "'" * len(QUOTES))
+_FOLD_TABLE = dict(_QUOTES)
+_FOLD_TABLE.update(dict.fromkeys(map(ord, _DIACRITICS)))
+# Chinese and Japanese scripts, which are written without spaces between words (Korean is not)
+CJK = "\u3005\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f\U00020000-\U0002fa1f"
+
+_PUNCTUATION = re.compile(r"[^\w\s'\-%s]" % MARKS)
+_CJK = re.compile(r"([%s]+)" % CJK)
+# Each CJK character is a run of its own
+_RUN = re.compile(r"[%s]|(?:[^\W%s]|[%s])+" % (CJK, CJK, MARKS))
+_ASCII_RUN = re.compile(r"\w+")  # Faster, for text without marks
+# Strong's numbers in the lemmas of tagged modules, e.g., "strong:H0430"
+STRONGS = re.compile(r"strong:([GH])0*(\d+)", re.IGNORECASE)
+
+_case_table = None
+
+
+def unify_quotes(text):
+    return text.translate(_QUOTES)
+
+
+def fold(text):
+    # Case-folds text and removes its diacritics, so that words match regardless of their accents
+    if text.isascii():
+        return text.casefold()
+    # Diacritics are removed before case-folding too, which would turn iota subscripts into iotas
+    text = unicodedata.normalize("NFKD", text).translate(_FOLD_TABLE)
+    return unicodedata.normalize("NFC", text.casefold().translate(_FOLD_TABLE))
+
+
+def _get_case_table():
+    # Maps each character to one that stands for all of the characters that re.IGNORECASE treats
+    # as the same letter, e.g., "S" and "\u017f" (long s) to "s"
+    global _case_table
+    if _case_table is None:
+        _case_table = {}
+        uppers = {}
+        for char in map(chr, range(0x20000)):
+            upper = char.upper()
+            if len(upper) == 1:
+                key = upper.lower()[0]
+            else:  # E.g., "\u0390" and "\u1fd3", which both upper-case to three characters
+                key = uppers.setdefault(upper, char)
+            if key != char:
+                _case_table[ord(char)] = key
+    return _case_table
+
+
+def fold_case(text):
+    # Unlike fold, this keeps the length of text, so that its n-grams line up with the original
+    if text.isascii():
+        return text.lower()
+    return text.translate(_get_case_table())
+
+
+def get_trigrams(verse):
+    # Trigrams of verse text as regular expressions see it, without the brackets of italics
+    text = fold_case(verse.replace("[", "").replace("]", ""))
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def has_cjk(text):
+    return _CJK.search(text) is not None
+
+
+def split_cjk(word):
+    # Splits the CJK text in word into overlapping pairs of characters, which is how it is indexed
+    tokens = []
+    for i, part in enumerate(_CJK.split(word)):
+        if i % 2:
+            tokens.extend([part[j:j + 2] for j in range(len(part) - 1)] or [part])
+        elif part:
+            tokens.append(part)
+    return tokens
+
+
+def get_tokens(verse):
+    verse = unify_quotes(verse.replace("--", " "))
+    if verse.isascii() or not has_cjk(verse):
+        return _PUNCTUATION.sub(r"", verse).split()
+    # Punctuation separates words in CJK text, and bigrams should not span it
+    return [token2 for token in _PUNCTUATION.sub(r" ", verse).split()
+            for token2 in split_cjk(token)]
+
+
+def tokenize(verse):
+    return set(get_tokens(verse))
+
+
+def get_runs(text):
+    # Positions count runs of word characters, which is how phrases are matched in verse text
+    return (_ASCII_RUN if text.isascii() else _RUN).findall(text)
+
+
+def get_strongs(lemma):
+    return {prefix.upper() + number for prefix, number in STRONGS.findall(lemma)}
+
+
+def iter_runs(text):
+    return (_ASCII_RUN if text.isascii() else _RUN).finditer(text)
+
+
+def _get_book_tasks(Bible, positions):
+    for b in range(1, len(Bible)):
+        start, stop = BOOK_VERSE_OFFSETS[b - 1], BOOK_VERSE_OFFSETS[b]
+        if not Bible[b]:
+            yield start, [""] * (stop - start), None, positions
+            continue
+        lemmas = None
+        if Bible.has_tags():
+            lemmas = [[lemma for run, lemma, morph in Bible.get_tags(ordinal) if lemma]
+                      for ordinal in range(start, stop)]
+        yield start, [Bible.get_slot(ordinal) for ordinal in range(start, stop)], lemmas, positions
+
+
+def _index_book(args):
+    start, verses, lemmas, positions = args
+    postings = {}
+    lemma_postings = {}
+    trigrams = {}
+    run_positions = {}
+    folded = {}
+    starts = array("I")  # Position of the first run of each verse, relative to the book
+    position = 0
+    for ordinal, verse in enumerate(verses, start):
+        starts.append(position)
+        if not verse:
+            continue
+        for word in tokenize(verse):
+            postings.setdefault(word, array("H")).append(ordinal)
+        for trigram in get_trigrams(verse):
+            trigrams.setdefault(trigram, array("H")).append(ordinal)
+        if lemmas:
+            for key in set().union(*map(get_strongs, lemmas[ordinal - start])):
+                lemma_postings.setdefault(key, array("H")).append(ordinal)
+        if positions:
+            runs = get_runs(verse)
+            for i, run in enumerate(runs):
+                if run not in folded:
+                    folded[run] = fold(run)
+                run_positions.setdefault(folded[run], array("I")).append(position + i)
+            position += len(runs)
+    return postings, lemma_postings, trigrams, run_positions, starts, position
+
+
+def _merge_postings(postings, book_postings):
+    for word, ordinals in book_postings.items():
+        if word in postings:
+            postings[word].extend(ordinals)
+        else:
+            postings[word] = ordinals
+
+
+def _merge_books(results, progress_callback=None):
+    postings = {}
+    lemmas = {}
+    trigrams = {}
+    run_positions = {}
+    starts = array("I")
+    position = 0
+    for b, result in enumerate(results, 1):
+        book_postings, book_lemmas, book_trigrams, book_positions, book_starts, count = result
+        _merge_postings(postings, book_postings)
+        _merge_postings(lemmas, book_lemmas)
+        _merge_postings(trigrams, book_trigrams)
+        for run, values in book_positions.items():
+            if position:
+                values = array("I", [value + position for value in values])
+            if run in run_positions:
+                run_positions[run].extend(values)
+            else:
+                run_positions[run] = values
+        starts.extend([value + position for value in book_starts])
+        position += count
+        if progress_callback:
+            progress_callback(b)
+    starts.append(position)
+    return postings, lemmas, trigrams, run_positions, starts
+
+
+def build_index(Bible, progress_callback=None, positions=False, processes=None, pool=None):
+    # Books are tokenized in parallel, and their postings are appended in canonical order
+    tasks = _get_book_tasks(Bible, positions)
+    if processes == 1:
+        results = _merge_books(map(_index_book, tasks), progress_callback)
+    elif pool is not None:
+        results = _merge_books(pool.imap(_index_book, tasks), progress_callback)
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            results = _merge_books(pool.imap(_index_book, tasks), progress_callback)
+    postings, lemmas, trigrams, run_positions, starts = results
+    if not positions:
+        return postings, None, lemmas, trigrams
+    return postings, (run_positions, starts), lemmas, trigrams
+
+
+def get_fingerprint(Bible):
+    return FINGERPRINT.pack(FORMAT_VERSION, TOKENIZER_VERSION, Bible.get_checksum())
+
+
+def get_grams(text):
+    return {text[i:i + n] for n in range(1, GRAM_SIZE + 1) for i in range(len(text) - n + 1)}
+
+
+def fold_terms(postings):
+    folded = {}
+    variants = {}
+    for i, term in enumerate(sorted(postings)):
+        key = fold(term)
+        folded.setdefault(key, []).append(postings[term])
+        variants.setdefault(key, array("I")).append(i)
+    for key, values in folded.items():
+        folded[key] = values[0] if len(values) == 1 else array("H", sorted(set().union(*values)))
+    return folded, variants
+
+
+def build_lexicon(terms):
+    grams = {}
+    for i, term in enumerate(sorted(terms)):
+        for gram in get_grams("^%s$" % term):
+            if gram not in ("^", "$"):
+                grams.setdefault(gram, array("I")).append(i)
+    return grams
+
+
+def build_dictionaries(postings, positions=None, lemmas=None, trigrams=None):
+    folded, variants = fold_terms(postings)
+    dictionaries = {"terms": postings, "folded": folded, "variants": variants,
+                    "grams": build_lexicon(folded)}
+    if trigrams is not None:  # For regular expression searches
+        dictionaries["trigrams"] = trigrams
+    arrays = {}
+    if positions is not None:
+        dictionaries["positions"], arrays["starts"] = positions
+    if lemmas:  # Strong's numbers of tagged Bibles, e.g., "G26"
+        dictionaries["lemmas"] = lemmas
+    return dictionaries, arrays
+
+
+def encode_deltas(values):
+    data = bytearray()
+    last = 0
+    for value in values:
+        delta = value - last
+        last = value
+        while delta >= 0x80:
+            data.append(delta & 0x7F | 0x80)
+            delta >>= 7
+        data.append(delta)
+    return data
+
+
+def decode_deltas(data):
+    if not data:
+        return array("I")
+    elif max(data) < 0x80:  # Every delta fits in one byte
+        return array("I", accumulate(data))
+    values = array("I")
+    last = value = shift = 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            last += value
+            values.append(last)
+            value = shift = 0
+    return values
+
+
+_BITMAP_DIGITS = bytes.maketrans(b"\x00\x01", b"01")
+_BITMAP_FLAGS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def to_bitmap(ordinals):
+    # Returns the verse bitmap of ordinals, an int with bit n set if verse n is one of them.
+    # Bitwise operators then intersect, unite and subtract sets of verses a machine word at a
+    # time, and duplicate ordinals disappear.
+    flags = bytearray(VERSE_COUNT)
+    for ordinal in ordinals:
+        flags[ordinal] = 1
+    return int(flags[::-1].translate(_BITMAP_DIGITS), 2)
+
+
+def from_bitmap(bitmap):
+    # Returns the sorted ordinals of the verses in a verse bitmap
+    digits = bin(bitmap)[:1:-1]  # Lowest bit first
+    if digits.count("1") > SPARSE_BITMAP:
+        flags = digits.encode("ascii").translate(_BITMAP_FLAGS)
+        return array("I", compress(range(len(flags)), flags))
+    ordinals = array("I")
+    i = digits.find("1")
+    while i != -1:
+        ordinals.append(i)
+        i = digits.find("1", i + 1)
+    return ordinals
+
+
+def write_index(filename, dictionaries, arrays=None, fingerprint=b""):
+    sections = [("fingerprint", fingerprint)]
+    for name, postings in dictionaries.items():
+        keys = [key.encode("utf-8") for key in sorted(postings)]
+        values = [encode_deltas(postings[key.decode("utf-8")]) for key in keys]
+        sections.append((name + ".keys", b"".join(keys)))
+        sections.append((name + ".keyidx", pack_uint32(accumulate([0] + list(map(len, keys))))))
+        sections.append((name + ".values", b"".join(values)))
+        sections.append((name + ".validx", pack_uint32(accumulate([0] + list(map(len, values))))))
+    for name, values in (arrays or {}).items():
+        sections.append((name, pack_uint32(values)))
+    flags = FLAG_POSITIONS if "positions" in dictionaries else 0
+
+    position = HEADER.size + SECTION.size * len(sections)
+    temp_file = filename + ".tmp"
+    with open(temp_file, 'wb') as fileobj:
+        fileobj.write(HEADER.pack(MAGIC, FORMAT_VERSION, flags, len(sections)))
+        for name, data in sections:
+            fileobj.write(SECTION.pack(name.encode("ascii"), position, len(data)))
+            position += len(data)
+        for name, data in sections:
+            fileobj.write(data)
+    os.replace(temp_file, filename)
+
+
+def is_index(filename, flags=0):
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as fileobj:
+        header = fileobj.read(HEADER.size)
+    return (len(header) == HEADER.size and
+            HEADER.unpack(header)[:3] == (MAGIC, FORMAT_VERSION, flags))
+
+
+def prune_indexes(index_dir, versions):
+    # Deletes indexes of versions that are no longer installed or enabled
+    for filename in glob.glob(os.path.join(index_dir, "*.idx")):
+        if os.path.splitext(os.path.basename(filename))[0] not in versions:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+
+def open_index(filename):
+    with open(filename, 'rb') as fileobj:
+        buffer = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, flags, section_count = HEADER.unpack_from(buffer)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        buffer.close()
+        raise ValueError("%s is not a supported index file" % filename)
+    sections = {}
+    for i in range(section_count):
+        name, offset, length = SECTION.unpack_from(buffer, HEADER.size + SECTION.size * i)
+        sections[name.rstrip(b"\0").decode("ascii")] = (offset, offset + length)
+    return Index(buffer, sections)
+
+
+class IndexCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._indexes = OrderedDict()
+        self._size = 0
+
+    def get(self, key):
+        index = self._indexes.get(key)
+        if index is not None:
+            self._indexes.move_to_end(key)
+        return index
+
+    def add(self, key, index):
+        self.remove(key)
+        self._indexes[key] = index
+        self._size += index.size
+        while self._size > self.max_size and len(self._indexes) > 1:
+            index = self._indexes.popitem(False)[1]
+            self._size -= index.size
+            index.close()
+
+    def remove(self, key):
+        index = self._indexes.pop(key, None)
+        if index is not None:
+            self._size -= index.size
+            index.close()
+
+    def __contains__(self, key):
+        return key in self._indexes
+
+
+class Index:
+    def __init__(self, buffer, sections):
+        self._buffer = buffer
+        self.size = len(buffer)
+        self.fingerprint = buffer[slice(*sections["fingerprint"])] if "fingerprint" in sections \
+            else None
+        self.terms = Dictionary(buffer, sections, "terms")
+        self.folded = Dictionary(buffer, sections, "folded")
+        self.variants = Dictionary(buffer, sections, "variants")
+        self.grams = Dictionary(buffer, sections, "grams")
+        self.positions = None
+        self.starts = None
+        self.lemmas = None
+        self.trigrams = None
+        if "lemmas.keys" in sections:
+            self.lemmas = Dictionary(buffer, sections, "lemmas")
+        if "trigrams.keys" in sections:
+            self.trigrams = Dictionary(buffer, sections, "trigrams")
+        if "positions.keys" in sections:
+            self.positions = Dictionary(buffer, sections, "positions")
+            self.starts = unpack_uint32(buffer, *sections["starts"])
+        self._users = 0  # Searches running on background threads
+        self._closing = False
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Keeps the index open until release is called, even if it is closed in the meantime
+        with self._lock:
+            self._users += 1
+        return self
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            if self._users > 0 or not self._closing:
+                return
+        self._close()
+
+    def close(self):
+        # Waits for the searches that are using the index to release it
+        with self._lock:
+            self._closing = True
+            if self._users > 0:
+                return
+        self._close()
+
+    def _close(self):
+        for dictionary in (self.terms, self.folded, self.variants, self.grams, self.positions,
+                           self.lemmas, self.trigrams):
+            if dictionary is not None:
+                dictionary.close()
+        if isinstance(self.starts, memoryview):
+            self.starts.release()
+        self._buffer.close()
+
+    def prefetch(self):
+        if hasattr(self._buffer, "madvise"):
+            self._buffer.madvise(mmap.MADV_WILLNEED)
+        else:
+            for i in range(0, self.size, mmap.PAGESIZE):
+                self._buffer[i]
+
+    def get(self, term):
+        return self.terms.get(term)
+
+    def __contains__(self, term):
+        return term in self.terms
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def __len__(self):
+        return len(self.terms)
+
+
+class Dictionary:
+    def __init__(self, buffer, sections, name):
+        self._buffer = buffer
+        self._keys_start = sections[name + ".keys"][0]
+        self._key_offsets = unpack_uint32(buffer, *sections[name + ".keyidx"])
+        self._values_start = sections[name + ".values"][0]
+        self._value_offsets = unpack_uint32(buffer, *sections[name + ".validx"])
+
+    def close(self):
+        for offsets in (self._key_offsets, self._value_offsets):
+            if isinstance(offsets, memoryview):
+                offsets.release()
+
+    def _get_key(self, i):
+        return self._buffer[self._keys_start + self._key_offsets[i]:
+                            self._keys_start + self._key_offsets[i + 1]]
+
+    def get_key(self, i):
+        return self._get_key(i).decode("utf-8")
+
+    def find(self, key):
+        key = key.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._get_key(low) == key:
+            return low
+        return -1
+
+    def get_size(self, i):
+        return self._value_offsets[i + 1] - self._value_offsets[i]
+
+    def get_values(self, i):
+        return decode_deltas(self._buffer[self._values_start + self._value_offsets[i]:
+                                          self._values_start + self._value_offsets[i + 1]])
+
+    def get_bitmap(self, i):
+        # Postings of verse ordinals as a verse bitmap
+        return to_bitmap(self.get_values(i))
+
+    def get(self, key, default=None):
+        i = self.find(key)
+        if i == -1:
+            return default
+        return self.get_values(i)
+
+    def __contains__(self, key):
+        return self.find(key) != -1
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._get_key(i).decode("utf-8")
+
+    def __len__(self):
+        return len(self._key_offsets) - 1
+
+
+def index_bible(filename, index_file, positions=True, progress_callback=None, processes=None):
+    Bible = open_bible(filename)
+    try:
+        write_index(index_file, *build_dictionaries(*build_index(Bible, progress_callback,
+                                                                 positions, processes)),
+                    get_fingerprint(Bible))
+    finally:
+        Bible.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        sys.exit("Usage: python index.py <.bbl file> <.idx file> [--no-positions]")
+    index_bible(sys.argv[1], sys.argv[2], "--no-positions" not in sys.argv[3:])
@@ -5,6 +5,7 @@ import os
 import wx
 from wx import adv, aui
 
+import bible
 import html2
 import menu
 import parallel
@@ -47,7 +48,8 @@ class MainWindow(wx.Frame):
         self.version_list = app.config.ReadList("VersionList", ["KJV"])
         self.verse_history = app.config.ReadList("History")
         self.history_item = -1
-        self.old_versions = []
+        self.catalog = bible.VersionCatalog(os.path.join(app.userdatadir, "catalog.dat"))
+        bible.chunk_cache.max_size = app.config.ReadInt("Main/ChunkCacheSize", 16) * 1024 * 1024
         self.printing = html2.PrintingSystem(self)
 
         extra_flags = aui.AUI_MGR_DEFAULT | aui.AUI_MGR_LIVE_RESIZE
@@ -246,11 +248,13 @@ class MainWindow(wx.Frame):
         event.Skip()
 
     def OnClose(self, event):
-        for version in self.old_versions:  # Delete old indexes
-            filename = os.path.join(self._app.userdatadir, "indexes", "%s.idx" % version)
-            if os.path.isfile(filename):
-                wx.CallAfter(os.remove, filename)
+        self.search.cancel_search()
+        self.search.result_cache.save()
+        if self.search.pool is not None:
+            self.search.pool.terminate()
+        self.search.index_queue.terminate()
         self._app.config.save()
+        self.catalog.save()
         with open(os.path.join(self._app.userdatadir, "layout.dat"), 'w') as fileobj:
             fileobj.write(self.aui.SavePerspective())
         self.aui.UnInit()
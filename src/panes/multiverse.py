@@ -1,9 +1,11 @@
 """multiverse.py - multi-verse retrieval pane class"""
 
+from itertools import groupby
+
 import wx
 from wx import aui, html
 
-from constants import BOOK_NAMES
+from constants import BOOK_NAMES, ORDINAL_CHAPTERS, ORDINAL_VERSES, verse_ordinal
 from html2 import HtmlWindowBase
 from refalize import refalize2
 
@@ -77,14 +79,18 @@ class MultiVersePane(wx.SplitterWindow):
                         results.append(_("<p><font color=\"gray\">%s %d:%d is not in the %s."
                                          "</font></p>") % (BOOK_NAMES[b - 1], c, v, version_name))
                 else:
-                    for c3 in range(c, c2 + 1):
-                        v3 = 1 if c3 != c else v
-                        v4 = len(Bible[b][c3]) - 1 if c3 != c2 else v2
+                    ordinals = range(verse_ordinal(b, c, v), verse_ordinal(b, c2, v2) + 1)
+                    if not ordinals:
+                        raise IndexError
+                    for c3, group in groupby(ordinals, ORDINAL_CHAPTERS.__getitem__):
+                        group = list(group)
+                        v3, v4 = ORDINAL_VERSES[group[0]], ORDINAL_VERSES[group[-1]]
                         verses = []
-                        for v5 in range(v3, v4 + 1):
-                            if Bible[b][c3][v5]:
+                        for ordinal in group:
+                            verse = Bible.get_slot(ordinal)
+                            if verse:
                                 verses.append("<font size=\"-1\">%d&nbsp;</font>%s" %
-                                              (v5, Bible[b][c3][v5]))
+                                              (ORDINAL_VERSES[ordinal], verse))
                         if not verses:
                             raise IndexError
                         results.append("<p><a href=\"%d.%d.%d\">%s %d:%d-%d (%s)</a><br>%s</p>" %
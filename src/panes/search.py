@@ -1,8 +1,7 @@
 """search.py - search pane class"""
 
-import difflib
+import multiprocessing
 import os
-import pickle
 import re
 import threading
 import time
@@ -10,13 +9,24 @@ import time
 import wx
 from wx import aui, html
 
-from constants import BOOK_NAMES, BOOK_RANGES
+from constants import (BOOK_NAMES, BOOK_RANGES, BOOK_VERSE_OFFSETS, ORDINAL_VERSES,
+                       verse_references)
+from engine import (ResultCache, format_plan, get_cache_key, get_flags, get_pattern,
+                    get_query_words, get_scan_ordinals, get_scan_tasks, parse_boolean,
+                    parse_query, refine, scan_book, search_boolean, search_index, search_version,
+                    suggest)
 from html2 import HtmlWindowBase
 from refalize import validate
-from utils import index_version
+from index import (FLAG_POSITIONS, IndexCache, from_bitmap, get_fingerprint, is_index,
+                   open_index, prune_indexes, to_bitmap, unify_quotes)
+from utils import EVT_INDEX_DONE, EVT_INDEX_LOADED, EVT_INDEX_PROGRESS, IndexQueue, load_index
 
 _ = wx.GetTranslation
 
+ALL_VERSIONS = "*"
+BATCH_SIZE = 100  # Verses that are shown at a time while a search is running
+MIN_LIVE_SEARCH = 2  # Characters that have to be typed before searching as you type
+
 
 class SearchPane(wx.Panel):
     def __init__(self, parent):
@@ -24,27 +34,56 @@ class SearchPane(wx.Panel):
         self._parent = parent
         self.abbrev_results = parent._app.config.ReadInt("Search/AbbrevResults", 1000)
         self.html = ""
-        self.indexes = {}
+        self.indexes = IndexCache(parent._app.config.ReadInt("Search/IndexCacheSize", 32) *
+                                  1024 * 1024)
+        self.result_cache = ResultCache(
+            parent._app.config.ReadInt("Search/ResultCacheSize", 4) * 1024 * 1024,
+            os.path.join(parent._app.index_dir, "results.dat")
+            if parent._app.config.ReadBool("Search/SaveResults", True) else None)
+        self.index_queue = IndexQueue()
+        self.indexing = set()  # Versions whose indexes are queued or being built
+        self.loading = set()
+        self.pending_search = None  # Version to search when its index is ready
+        self.pool = None  # Worker processes for regular expressions and searching all versions
+        self.pool_lock = threading.Lock()
+        self.search_token = None  # Set to stop the search in progress
+        self.search_text = None
+        self.search_results = []
+        self.search_time = 0
+        self.time_budget = parent._app.config.ReadInt("Search/TimeBudget", 10)  # Seconds
+        self.live_delay = parent._app.config.ReadInt("Search/LiveSearchDelay", 300)  # Msec
+        self.refinable = None  # Version, range, words, links, options and matches of a search
+        self.show_plan = parent._app.config.ReadBool("Search/ShowPlan", False)
+        self.search_plan = None  # Boolean query of the last search
         self.last_search = (None, -1, -1)  # Text, Number of Verses, Version
         self.options = ("AllWords", "CaseSensitive", "ExactMatch", "Phrase", "RegularExpression")
+        self.positionless_versions = parent._app.config.ReadList("Search/PositionlessVersions")
+        self.Bind(EVT_INDEX_PROGRESS, self.OnIndexProgress)
+        self.Bind(EVT_INDEX_DONE, self.OnIndexDone)
+        self.Bind(EVT_INDEX_LOADED, self.OnIndexLoaded)
 
-        for i in range(len(parent.version_list)):
-            if not os.path.isfile(os.path.join(parent._app.index_dir, "%s.idx" % parent.version_list[i])):
-                self.indexes[parent.version_list[i]] = \
-                    index_version(parent.version_list[i], parent.get_htmlwindow(i).Bible, parent._app.index_dir)
-        if len(self.indexes) < len(parent.version_list):  # If not all loaded
-            thread = threading.Thread(target=self.load_indexes)
-            thread.start()
-            wx.CallAfter(thread.join)
+        prune_indexes(parent._app.index_dir, parent.version_list)
+        self.result_cache.prune(parent.version_list)
+        for version in parent.version_list:  # Indexes are loaded when they are first searched
+            if not self.has_index(version):
+                self.rebuild_index(version)
 
         self.text = wx.ComboBox(self, choices=parent._app.config.ReadList("Search/SearchHistory"),
                                 style=wx.TE_PROCESS_ENTER)
         self.text.SetValue(parent._app.config.Read("Search/LastSearch"))
         self.text.Bind(wx.EVT_TEXT_ENTER, self.OnSearch)
+        self.text.Bind(wx.EVT_TEXT, self.OnText)
+        self.live_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.OnLiveSearch, self.live_timer)
         self.toolbar = aui.AuiToolBar(self, wx.ID_ANY, style=aui.AUI_TB_DEFAULT_STYLE | aui.AUI_TB_PLAIN_BACKGROUND)
         ID_SEARCH = wx.NewId()
         self.toolbar.AddTool(ID_SEARCH, "", parent.get_bitmap("search"), _("Search"))
         self.toolbar.Bind(wx.EVT_MENU, self.OnSearch, id=ID_SEARCH)
+        self.toolbar.AddTool(wx.ID_STOP, "", wx.ArtProvider.GetBitmap(wx.ART_CROSS_MARK,
+                                                                      wx.ART_TOOLBAR, (16, 16)),
+                             _("Cancel Search"))
+        self.toolbar.EnableTool(wx.ID_STOP, False)
+        self.toolbar.Bind(wx.EVT_MENU, self.OnCancel, id=wx.ID_STOP)
         self.toolbar.AddTool(wx.ID_PREVIEW, "", parent.get_bitmap("print"),
                              _("Print Results"))
         self.toolbar.EnableTool(wx.ID_PREVIEW, False)
@@ -66,10 +105,13 @@ class SearchPane(wx.Panel):
         if self.RegularExpression.GetValue():
             for option in ("AllWords", "ExactMatch", "Phrase"):
                 getattr(self, option).Disable()
+        self.live_search = wx.CheckBox(optionspane, label=_("Search as You Type"))
+        self.live_search.SetValue(parent._app.config.ReadBool("Search/LiveSearch", False))
         self.Bind(wx.EVT_CHECKBOX, self.OnCheckbox)
-        self.version = wx.Choice(optionspane, choices=parent.version_list)
+        self.version = wx.Choice(optionspane, choices=parent.version_list +
+                                 ([_("All Versions")] if len(parent.version_list) > 1 else []))
         tab = parent.notebook.GetSelection()
-        self.version.SetSelection(int(tab < len(parent.version_list)) and tab)
+        self.version.SetSelection(int(tab < self.version.GetCount()) and tab)
         ranges = (_("Entire Bible"), _("Old Testament"), _("Pentateuch (Gen - Deut)"),
                   _("History (Josh - Esth)"), _("Wisdom (Job - Song)"),
                   _("Major Prophets (Isa - Dan)"), _("Minor Prophets (Hos - Mal)"),
@@ -101,6 +143,7 @@ class SearchPane(wx.Panel):
         sizer3 = wx.BoxSizer(wx.VERTICAL)
         for option in self.options:
             sizer3.Add(getattr(self, option), 0, wx.ALL, 2)
+        sizer3.Add(self.live_search, 0, wx.ALL, 2)
         box = wx.StaticBox(optionspane, label=_("Search in"))
         sizer4 = wx.StaticBoxSizer(box, wx.VERTICAL)
         sizer5 = wx.BoxSizer(wx.HORIZONTAL)
@@ -117,205 +160,492 @@ class SearchPane(wx.Panel):
         sizer.Add(self.optionspane, 0, wx.ALL | wx.EXPAND, 2)
         self.SetSizer(sizer)
 
-    def load_indexes(self):
-        for version in self._parent.version_list:
-            if version not in self.indexes:
-                with open(os.path.join(self._parent._app.index_dir, "%s.idx" % version), 'rb') as fileobj:
-                    self.indexes[version] = pickle.load(fileobj)
+    def get_bible(self, version):
+        return self._parent.get_htmlwindow(self._parent.version_list.index(version)).Bible
+
+    def has_index(self, version):
+        flags = FLAG_POSITIONS if version not in self.positionless_versions else 0
+        return is_index(os.path.join(self._parent._app.index_dir, "%s.idx" % version), flags)
+
+    def get_index(self, version):
+        index = self.indexes.get(version)
+        if index is None and version not in self.indexing and version not in self.loading:
+            if self.has_index(version):
+                self.loading.add(version)
+                load_index(self, version, self._parent._app.index_dir)
+            else:
+                self.rebuild_index(version)
+        return index
+
+    def rebuild_index(self, version):
+        if version in self.indexing:
+            return
+        self.indexes.remove(version)
+        if not self.indexing:
+            self._parent.statusbar.PushStatusText(_("Indexing %s...") % version, 0)
+        self.indexing.add(version)
+        self.index_queue.add(self, version, self.get_bible(version), self._parent._app.index_dir,
+                             version not in self.positionless_versions)
+
+    def OnIndexProgress(self, event):
+        self._parent.statusbar.SetStatusText(_("Indexing %s (%s)...") %
+                                             (event.version, BOOK_NAMES[event.book - 1]), 0)
+
+    def OnIndexDone(self, event):
+        self.indexing.discard(event.version)
+        if not self.indexing:
+            self._parent.statusbar.PopStatusText(0)
+        if event.error is not None:
+            wx.MessageBox(_("Failed to index %s:\n%s") % (event.version, event.error), "Berean",
+                          wx.ICON_ERROR | wx.OK)
+            return
+        self.indexes.add(event.version, open_index(event.filename))
+        self.resume_search(event.version)
+
+    def OnIndexLoaded(self, event):
+        self.loading.discard(event.version)
+        index = event.index
+        Bible = self.get_bible(event.version)
+        if index is not None and index.fingerprint != get_fingerprint(Bible):
+            index.close()  # The Bible or tokenizer has changed since it was indexed
+            index = None
+        if index is None:
+            self.rebuild_index(event.version)
+            return
+        self.indexes.add(event.version, index)
+        self.resume_search(event.version)
+
+    def is_all_versions(self, selection):
+        return selection == len(self._parent.version_list)
+
+    def resume_search(self, version):
+        if self.pending_search == ALL_VERSIONS:
+            if not self.indexing and not self.loading:
+                self.pending_search = None
+                if self.is_all_versions(self.version.GetSelection()):
+                    self.OnSearch(None)
+        elif self.pending_search == version:
+            self.pending_search = None
+            if self.version.GetStringSelection() == version:
+                self.OnSearch(None)
+
+    def show_message(self, message):
+        self.htmlwindow.SetPage("<html><body><font size=\"%d\">%s</font></body></html>" %
+                                (self._parent.zoom_level, message))
+
+    def OnText(self, event):
+        if self.live_search.GetValue():
+            self.live_timer.StartOnce(self.live_delay)  # Restarted by each key typed
+        event.Skip()
+
+    def OnLiveSearch(self, event):
+        text = self.text.GetValue().strip()
+        current = self.search_text[0] if self.search_token is not None else self.last_search[0]
+        if len(text) >= MIN_LIVE_SEARCH and text != current:
+            self.OnSearch(None, True)
 
-    def OnSearch(self, event):
+    def OnSearch(self, event, live=False):
+        # Live searches are run while typing, and leave the results of the previous search on
+        # the page until their own are ready
+        self.live_timer.Stop()
         text = self.text.GetValue().strip()
         if not text:
             return
         elif validate(text, False):
+            if live:  # Verse references are only gone to when asked
+                return
             self._parent.toolbar.verse_entry.SetValue(text)
             self.text.SetValue(self.text.GetString(0))
             self._parent.toolbar.OnGoToVerse(None)
             return
+        self.cancel_search()  # A new search replaces the one in progress
+        selection = self.version.GetSelection()
         version_name = self.version.GetStringSelection()
+        all_versions = self.is_all_versions(selection)
+        options = self.get_options()
+        if (not all_versions and not options["RegularExpression"] and
+                self.get_index(version_name) is None):
+            self.pending_search = version_name
+            if version_name in self.indexing:
+                self.show_message(_("<p>Indexing the %s...</p>") % version_name)
+            else:
+                self.show_message(_("<p>Loading the index for the %s...</p>") % version_name)
+            return
         try:
+            query = self.get_query(text, options)
+        except re.error as exc:
+            if live:  # Probably not finished yet
+                return
+            self.show_message(_("<p>Invalid regular expression: %s</p>") % exc)
+            return
+        except ValueError as exc:
+            if live:
+                return
+            self.show_message(_("<p>Invalid search: %s</p>") % exc)
+            return
+        if all_versions:
+            versions = [(version, self.get_bible(version), self._parent.get_htmlwindow(i).filename,
+                         None) for i, version in enumerate(self._parent.version_list)]
+            self._parent.statusbar.PushStatusText(_("Searching all versions..."), 0)
+        else:
+            htmlwindow = self._parent.get_htmlwindow(selection)
+            # Regular expressions do not wait for the index, but use it once it is loaded
+            versions = [(version_name, htmlwindow.Bible, htmlwindow.filename,
+                         self.get_index(version_name))]
             self._parent.statusbar.PushStatusText(_("Searching %s...") % version_name, 0)
-            with wx.BusyCursor():
-                sec = time.time()
-                results, count = self.get_results(text)
-                results.insert(0, _("<font color=\"gray\">%d verses in the %s "
-                                    "(%d&nbsp;msec)</font>") %
-                               (count, version_name, max(1, (time.time() - sec) * 1000)))
-                if count == 0:
-                    results.append(_("<p>No verses were found.</p><p>Did you mean:<ul>"))
-                    words = self.indexes[version_name].keys()
-                    if text in words:
-                        words.remove(text)
+        for version, Bible, filename, index in versions:
+            if index is not None:  # Evicting or rebuilding it waits for the search to finish
+                index.acquire()
+        self.search_token = token = threading.Event()
+        self.search_text = (text, selection, live)
+        self.search_plan = query[5]
+        self.search_results = []
+        self.search_time = time.time()
+        self.toolbar.EnableTool(wx.ID_STOP, True)
+        self.toolbar.Refresh(False)
+        if not live:  # Results are appended to this page as they are found
+            self.htmlwindow.SetPage("<html><body><font size=\"%d\">%s" %
+                                    (self._parent.zoom_level,
+                                     _("<font color=\"gray\">Searching...</font>")))
+        # Live searches are not saved in the result cache, since most of them are half typed
+        thread = threading.Thread(target=self.run_search,
+                                  args=(token, query, versions, not live), daemon=True)
+        thread.start()
+
+    def OnCancel(self, event):
+        if self.search_token is not None:
+            self.search_token.set()  # The results found so far are still shown
+
+    def cancel_search(self):
+        # Stops the search in progress, and drops its results
+        if self.search_token is not None:
+            self.search_token.set()
+            self.search_token = None
+            self._parent.statusbar.PopStatusText(0)
+            self.toolbar.EnableTool(wx.ID_STOP, False)
+            self.toolbar.Refresh(False)
+
+    def OnSearchResults(self, token, results):
+        if token is not self.search_token:
+            return
+        self.search_results.append(results)
+        if self.search_text[2] and len(self.search_results) == 1:
+            # The first verses found by a live search replace the results of the previous one
+            self.htmlwindow.SetPage("<html><body><font size=\"%d\">%s%s" %
+                                    (self._parent.zoom_level,
+                                     _("<font color=\"gray\">Searching...</font>"), results))
+            return
+        x, y = self.htmlwindow.GetViewStart()
+        self.htmlwindow.AppendToPage(results)
+        self.htmlwindow.Scroll(x, y)
+
+    def OnSearchDone(self, token, result, error):
+        if token is not self.search_token:
+            return
+        self.search_token = None
+        self._parent.statusbar.PopStatusText(0)
+        self.toolbar.EnableTool(wx.ID_STOP, False)
+        self.toolbar.Refresh(False)
+        if error is not None:
+            self.show_message(_("<p>The search failed: %s</p>") % error)
+            return
+        text, selection, live = self.search_text
+        count, stopped, version_results, references = result
+        msec = max(1, (time.time() - self.search_time) * 1000)
+        if version_results is None:
+            version_name = self.version.GetString(selection)
+            results = [_("<font color=\"gray\">%d verses in the %s (%d&nbsp;msec)</font>") %
+                       (count, version_name, msec)]
+        else:
+            counts = []
+            for version in self._parent.version_list:
+                if version not in version_results:
+                    counts.append(_("%s: stopped") % version)
+                elif version_results[version] is None:  # The index is missing or out of date
+                    self.get_index(version)
+                    self.pending_search = ALL_VERSIONS
+                    counts.append(_("%s: indexing") % version)
+                else:
+                    counts.append("%s:&nbsp;%d" % (version, len(version_results[version])))
+            results = [_("<font color=\"gray\">%d verses in %d versions (%d&nbsp;msec)<br>%s"
+                         "</font>") % (count, len(counts), msec, ", ".join(counts))]
+        if stopped:
+            results.append(_("<p>The search was stopped before it finished, so only the verses "
+                             "that were found by then are shown.</p>"))
+        results.extend(self.search_results if references is None else references)
+        if self.show_plan and self.search_plan is not None and version_results is None:
+            if self.search_plan.estimate is None:  # The plan did not have to be run
+                plan = _("Found in the result cache")
+            else:
+                plan = "\n".join(format_plan(self.search_plan))
+            results.insert(1, "<pre><font color=\"gray\">%s</font></pre>" % plan)
+        if count == 0:
+            results.append(_("<p>No verses were found.</p>"))
+            index = self.indexes.get(version_name) if version_results is None else None
+            if (index is not None and not self.RegularExpression.GetValue() and
+                    self.search_plan is None):
+                suggestions = suggest(index, text)
+                if suggestions:
+                    results.append(_("<p>Did you mean:<ul>"))
                     results.extend(["<li><a href=\"@%s\">%s</a></li>" % (li, li)
-                                    for li in difflib.get_close_matches(text, words, 5)])
+                                    for li in suggestions])
                     results.append("</ul></p>")
-                self.html = "<html><body><font size=\"%d\">%s</font></body></html>" % \
-                            (self._parent.zoom_level, "".join(results))
-                self.htmlwindow.SetPage(self.html)
-        finally:
-            self._parent.statusbar.PopStatusText(0)
+        self.html = "<html><body><font size=\"%d\">%s</font></body></html>" % \
+                    (self._parent.zoom_level, "".join(results))
+        x, y = self.htmlwindow.GetViewStart()
+        self.htmlwindow.SetPage(self.html)
+        self.toolbar.EnableTool(wx.ID_PREVIEW, count > 0)
+        self.toolbar.Refresh(False)
+        self.last_search = (text, count, selection)
+        if self.search_results:  # Keeps the place of whoever scrolled while results came in
+            self.htmlwindow.Scroll(x, y)
+        if live:  # Typing goes on in the search box
+            return
         if self.text.FindString(text) == -1:
             self.text.Insert(text, 0)
             if self.text.GetCount() > 10:
                 self.text.Delete(10)
-        self.toolbar.EnableTool(wx.ID_PREVIEW, count > 0)
-        self.toolbar.Refresh(False)
-        self.last_search = (text, count, self.version.GetSelection())
         self.htmlwindow.SetFocus()
 
-    def get_results(self, text):
-        text = text.replace(u"\u2019", "'")
-        Bible = self._parent.get_htmlwindow(self.version.GetSelection()).Bible
-        options = {}
-        for option in self.options:
-            options[option] = getattr(self, option).GetValue()
-        flags = re.UNICODE
-        if not options["CaseSensitive"]:
-            flags |= re.IGNORECASE
-        if not options["RegularExpression"]:
-            return self.get_indexed_results(re.escape(text), Bible, options, flags)
-        else:
-            matches = []
-            pattern = re.compile(text, flags)
-            for b in range(self.start.GetSelection() + 1, self.stop.GetSelection() + 2):
-                for c in range(1, len(Bible[b])):
-                    for v in range(1, len(Bible[b][c])):
-                        verse = Bible[b][c][v].replace("[", "").replace("]", "")
-                        if pattern.search(verse):
-                            matches.append((b, c, v))
-            return (self.format_matches(matches, pattern, options), len(matches))
-
-    def get_indexed_results(self, text, Bible, options, re_flags):
-        words = [re.sub(r"[^\w'\-]", r"", word, flags=re.UNICODE) for word in text.split()]
-        if options["AllWords"] or options["Phrase"]:
-            longest = ""
-            for word in words:
-                if len(word) >= len(longest):
-                    longest = word
-            matches = self.get_word_matches(longest, options)
-            if not matches:
-                return ([], 0)
-            if options["Phrase"]:
-                pattern = re.compile(r"\b%s\b" % r"\W+".join(words), re_flags)
-                matches = [item for item in matches
-                           if pattern.search(Bible[item[0]][item[1]][item[2]])]
-            elif options["AllWords"]:
-                words.remove(longest)
-                if options["ExactMatch"]:
-                    words = [r"\b%s\b" % word for word in words]
-                    longest = r"\b%s\b" % longest
-                for word in words:
-                    pattern = re.compile(word, re_flags)
-                    matches = [item for item in matches
-                               if pattern.search(Bible[item[0]][item[1]][item[2]])]
-                pattern = re.compile(r"(%s)" % "|".join([longest] + words), re_flags)
+    def get_options(self):
+        return {option: getattr(self, option).GetValue() for option in self.options}
+
+    def get_query(self, text, options):
+        # Returns what the background thread needs to know about a search. Raises re.error or
+        # ValueError if a regular expression or boolean query is invalid.
+        node = None
+        if options["RegularExpression"]:
+            pattern = re.compile(unify_quotes(text), get_flags(options))
+            words = links = None
         else:
-            matches = []
-            for word in words:
-                matches.extend(self.get_word_matches(word, options))
-            if not matches:
-                return ([], 0)
-            if options["ExactMatch"]:
-                pattern = re.compile(r"(%s)" % "|".join([r"\b%s\b" % word for word in words]),
-                                     re_flags)
-                matches = [item for item in matches
-                           if pattern.search(Bible[item[0]][item[1]][item[2]])]
+            node = parse_boolean(text)
+            if node is not None:  # Its words are highlighted wherever they are
+                words, links = get_query_words(node), []
+                pattern = get_pattern(words, links, dict(options, Phrase=False)) \
+                    if words else None
             else:
-                pattern = re.compile(r"(%s)" % "|".join(words), re_flags)
-        start = self.start.GetSelection() + 1
-        stop = self.stop.GetSelection() + 1
-        matches = [item for item in matches if start <= item[0] <= stop]
-        if not matches:
-            return ([], 0)
-        matches.sort()
-        last = matches[-1]
-        for i in range(len(matches) - 2, -1, -1):  # Remove duplicates
-            if matches[i] == last:
-                del matches[i]
+                words, links = parse_query(text)
+                pattern = get_pattern(words, links, options) if words else None
+        return (text, options, pattern, words, links, node) + self.get_range()
+
+    def get_range(self):
+        return (BOOK_VERSE_OFFSETS[self.start.GetSelection()],
+                BOOK_VERSE_OFFSETS[self.stop.GetSelection() + 1])
+
+    # The methods below run on the background thread of a search, and must not use wx except
+    # through wx.CallAfter
+
+    def run_search(self, token, query, versions, save=True):
+        try:
+            if len(versions) == 1:
+                result = self.search_bible(token, query, *versions[0], save=save)
             else:
-                last = matches[i]
-        return (self.format_matches(matches, pattern, options), len(matches))
-
-    def get_word_matches(self, word, options, recursive=False):
-        index = self.indexes[self.version.GetStringSelection()]
-        matches = []
-        if not options["CaseSensitive"]:
-            for case in {word.capitalize(), word.lower(), word.title(), word.upper()}:
-                if case in index:
-                    matches.extend([bytes(index[case][i:i + 3], encoding="latin1")
-                                    for i in range(0, len(index[case]), 3)])
-        elif word in index:
-            matches.extend([bytes(index[word][i:i + 3], encoding="latin1")
-                            for i in range(0, len(index[word]), 3)])
-        if not (recursive or options["ExactMatch"] or options["Phrase"]):
-            if not options["CaseSensitive"]:
-                lower = word.lower()
-                for word2 in index:
-                    lower2 = word2.lower()
-                    if lower in lower2 and lower2 != lower:
-                        matches.extend(self.get_word_matches(word2, {"CaseSensitive":
-                                                                         options["CaseSensitive"]},
-                                                             True))
+                result = self.search_versions(token, query, versions, save)
+        except Exception as exc:
+            wx.CallAfter(self.OnSearchDone, token, None, exc)
+        else:
+            wx.CallAfter(self.OnSearchDone, token, result, None)
+        finally:
+            for version, Bible, filename, index in versions:
+                if index is not None:
+                    index.release()
+
+    def post_results(self, token, results):
+        if results:
+            wx.CallAfter(self.OnSearchResults, token, "".join(results))
+
+    def is_abbreviated(self, count):
+        return self.abbrev_results != -1 and count > self.abbrev_results
+
+    def search_bible(self, token, query, version, Bible, filename, index, save=True):
+        # Searches one version, and posts its results as they are found. Returns the number of
+        # verses found, whether the search was stopped, None (for the results of each version)
+        # and the results to show instead of the posted ones, if there were too many. Searches
+        # that only narrow down the one before them are refined from its results.
+        text, options, pattern, words, links, node, start, stop = query
+        key = get_cache_key(text, options, start, stop)
+        fingerprint = get_fingerprint(Bible)
+        matches = self.result_cache.get(version, key, fingerprint)
+        stopped = posted = False
+        if matches is None:
+            if options["RegularExpression"]:
+                tasks = get_scan_tasks(filename, pattern,
+                                       get_scan_ordinals(pattern, start, stop, index))
+                matches = []
+                finished = 0
+                for book_matches in self.run_tasks(token, scan_book, tasks):
+                    finished += 1
+                    matches.extend(book_matches)
+                    if not self.is_abbreviated(len(matches)):  # Posted a book at a time
+                        self.post_results(token, self.format_verses(
+                            book_matches, pattern, options, [(None, Bible, None)]))
+                stopped = finished < len(tasks)
+                posted = True
+            elif node is not None:
+                matches = search_boolean(index, Bible, node, options, start, stop)
             else:
-                for word2 in index:
-                    if word in word2 and word2 != word:
-                        matches.extend(self.get_word_matches(word2, {"CaseSensitive":
-                                                                         options["CaseSensitive"]},
-                                                             True))
-        return matches
-
-    def format_matches(self, matches, pattern, options):
-        Bible = self._parent.get_htmlwindow(self.version.GetSelection()).Bible
-        results = []
-        if len(matches) <= self.abbrev_results or self.abbrev_results == -1:
-            for b, c, v in matches:
-                verse = Bible[b][c][v]
-                offset = 0
-                if not options["RegularExpression"]:
-                    for match in pattern.finditer(verse):
-                        start, end = match.span(0)
-                        verse = "%s<b>%s</b>%s" % \
-                                (verse[:start + offset], verse[start + offset:end + offset],
-                                 verse[end + offset:])
-                        offset += 7
-                else:
-                    for match in pattern.finditer(verse.replace("[", "").replace("]", "")):
-                        start, end = match.span(0)
-                        offset += (verse.count("[", offset, start + offset) +
-                                   verse.count("]", offset, start + offset))
-                        offset2 = (offset + verse.count("[", start + offset, end + offset) +
-                                   verse.count("]", start + offset, end + offset))
-                        verse = "%s<b>%s</b>%s" % \
-                                (verse[:start + offset], verse[start + offset:end + offset2],
-                                 verse[end + offset2:])
-                        offset += 7
-                results.append("<p><a href=\"%d.%d.%d\">%s %d:%d</a><br>%s</p>" %
-                               (b, c, v, BOOK_NAMES[b - 1], c, v,
-                                verse.replace("[", "<i>").replace("]", "</i>")))
+                previous = self.refinable
+                if words and previous is not None and previous[0] == (version, start, stop):
+                    matches = refine(index, previous[1], words, links, options)
+                if matches is None:
+                    matches = search_index(index, Bible, words, links, options, start, stop) \
+                        if words else []
+            if not stopped:
+                self.result_cache.add(version, key, fingerprint, matches, save)
+        if not options["RegularExpression"] and node is None:
+            self.refinable = ((version, start, stop), (words, links, options, matches))
+        if self.is_abbreviated(len(matches)):
+            return (len(matches), stopped, None, self.format_references(matches))
+        if not posted:
+            stopped = not self.post_verses(token, matches, pattern, options,
+                                           [(None, Bible, None)])
+        return (len(matches), stopped, None, None)
+
+    def post_verses(self, token, matches, pattern, options, versions):
+        # Posts the verses of matches a batch at a time, and returns False if the search was
+        # cancelled before they all were
+        for i in range(0, len(matches), BATCH_SIZE):
+            if token.is_set():
+                return False
+            self.post_results(token, self.format_verses(matches[i:i + BATCH_SIZE], pattern,
+                                                        options, versions))
+        return True
+
+    def search_versions(self, token, query, versions, save=True):
+        # Searches every version in worker processes, and posts the results of all of them
+        # merged by verse. Returns the same as search_bible, but with the results of each
+        # version that finished, which are None for versions whose index has to be rebuilt.
+        text, options, pattern, words, links, node, start, stop = query
+        if not options["RegularExpression"] and not words and node is None:
+            return (0, False, {version: [] for version, Bible, filename, index in versions}, None)
+        key = get_cache_key(text, options, start, stop)
+        fingerprints = {version: get_fingerprint(Bible)
+                        for version, Bible, filename, index in versions}
+        results = {}
+        for version, Bible, filename, index in versions:
+            version_matches = self.result_cache.get(version, key, fingerprints[version])
+            if version_matches is not None:
+                results[version] = version_matches
+        if options["RegularExpression"]:
+            text = pattern.pattern
+        index_dir = self._parent._app.index_dir
+        uncached = [(version, filename) for version, Bible, filename, index in versions
+                    if version not in results]
+        tasks = [(filename, os.path.join(index_dir, "%s.idx" % version), text, options, start,
+                  stop) for version, filename in uncached]
+        # Versions that were stopped before they finished are left out
+        for (version, filename), version_matches in zip(
+                uncached, list(self.run_tasks(token, search_version, tasks))):
+            results[version] = version_matches
+            if version_matches is not None:
+                self.result_cache.add(version, key, fingerprints[version], version_matches,
+                                      save)
+        verses = 0  # Merged as verse bitmaps, which drops the verses found in several versions
+        for version_matches in results.values():
+            if version_matches is not None:
+                verses |= to_bitmap(version_matches)
+        matches = from_bitmap(verses)
+        stopped = any(version not in results for version, Bible, filename, index in versions)
+        if self.is_abbreviated(len(matches)):
+            return (len(matches), stopped, results, self.format_references(matches))
+        labeled = [(version, Bible, set(results[version]))
+                   for version, Bible, filename, index in versions
+                   if results.get(version) is not None]
+        if not self.post_verses(token, matches, pattern, options, labeled):
+            stopped = True
+        return (len(matches), stopped, results, None)
+
+    def run_tasks(self, token, function, tasks):
+        # Runs tasks in a process pool and yields their results in order, until they are all
+        # done, the search is cancelled or its time budget runs out
+        with self.pool_lock:  # Each search has a pool of its own while it runs
+            pool, self.pool = self.pool or multiprocessing.Pool(), None
+        results = [pool.apply_async(function, (task,)) for task in tasks]
+        deadline = time.time() + self.time_budget
+        try:
+            for result in results:
+                while not result.ready():
+                    if token.is_set() or time.time() > deadline:
+                        return
+                    result.wait(0.05)
+                yield result.get()
+        finally:
+            with self.pool_lock:
+                if self.pool is None and all(result.ready() for result in results):
+                    self.pool = pool
+                    pool = None
+            if pool is not None:  # Workers may be stuck in a pathological pattern
+                pool.terminate()
+
+    def highlight(self, verse, pattern, options):
+        offset = 0
+        if pattern is None:  # A boolean query for verses without some words
+            pass
+        elif not options["RegularExpression"]:
+            for match in pattern.finditer(verse):
+                start, end = match.span(0)
+                verse = "%s<b>%s</b>%s" % \
+                        (verse[:start + offset], verse[start + offset:end + offset],
+                         verse[end + offset:])
+                offset += 7
         else:
-            results.append("<br>")
-            i = last_book = 0
-            while i < len(matches):
-                b, c, v = matches[i]
-                verses = 1
-                while i + verses < len(matches) and matches[i + verses] == (b, c, v + verses):
-                    verses += 1
-                if verses == 1:
-                    results.append(", <a href=\"%d.%d.%d\">%d:%d</a>" % (b, c, v, c, v))
-                else:
-                    results.append(", <a href=\"%d.%d.%d\">%d:%d-%d</a>" %
-                                   (b, c, v, c, v, v + verses - 1))
-                if b > last_book:
-                    results[-1] = "<br><b>%s</b>" % BOOK_NAMES[b - 1].upper() + results[-1][1:]
-                    last_book = b
-                i += verses
+            for match in pattern.finditer(verse.replace("[", "").replace("]", "")):
+                start, end = match.span(0)
+                offset += (verse.count("[", offset, start + offset) +
+                           verse.count("]", offset, start + offset))
+                offset2 = (offset + verse.count("[", start + offset, end + offset) +
+                           verse.count("]", start + offset, end + offset))
+                verse = "%s<b>%s</b>%s" % \
+                        (verse[:start + offset], verse[start + offset:end + offset2],
+                         verse[end + offset2:])
+                offset += 7
+        return verse.replace("[", "<i>").replace("]", "</i>")
+
+    def format_verses(self, matches, pattern, options, versions):
+        # Versions are (label, Bible, matches) tuples, and each verse is shown in every version
+        # that it matched in, or in all of them if their matches are None
+        results = []
+        for ordinal, (b, c, v) in zip(matches, verse_references(matches)):
+            verse = "<br>".join(
+                ("<font color=\"gray\">%s</font> " % label if label else "") +
+                self.highlight(Bible.get_slot(ordinal), pattern, options)
+                for label, Bible, version_matches in versions
+                if version_matches is None or ordinal in version_matches)
+            results.append("<p><a href=\"%d.%d.%d\">%s %d:%d</a><br>%s</p>" %
+                           (b, c, v, BOOK_NAMES[b - 1], c, v, verse))
+        return results
+
+    def format_references(self, matches):
+        results = ["<br>"]
+        references = verse_references(matches)
+        i = last_book = 0
+        while i < len(matches):
+            b, c, v = references[i]
+            verses = 1
+            while (i + verses < len(matches) and matches[i + verses] == matches[i] + verses and
+                   ORDINAL_VERSES[matches[i + verses]] == v + verses):
+                verses += 1
+            if verses == 1:
+                results.append(", <a href=\"%d.%d.%d\">%d:%d</a>" % (b, c, v, c, v))
+            else:
+                results.append(", <a href=\"%d.%d.%d\">%d:%d-%d</a>" %
+                               (b, c, v, c, v, v + verses - 1))
+            if b > last_book:
+                results[-1] = "<br><b>%s</b>" % BOOK_NAMES[b - 1].upper() + results[-1][1:]
+                last_book = b
+            i += verses
         return results
 
     def OnPrint(self, event):
-        header = _("<div align=\"center\"><font size=\"+1\"><b>Search Results for \"%s\" "
-                   "(%d verses in the %s)</b></font></div>") % \
-                 (self.last_search[0], self.last_search[1],
-                  self.version.GetString(self.last_search[2]))
+        if self.is_all_versions(self.last_search[2]):
+            header = _("<div align=\"center\"><font size=\"+1\"><b>Search Results for \"%s\" "
+                       "(%d verses in all versions)</b></font></div>") % \
+                     (self.last_search[0], self.last_search[1])
+        else:
+            header = _("<div align=\"center\"><font size=\"+1\"><b>Search Results for \"%s\" "
+                       "(%d verses in the %s)</b></font></div>") % \
+                     (self.last_search[0], self.last_search[1],
+                      self.version.GetString(self.last_search[2]))
         text = (self.html[:self.html.index("<font color=\"gray\">")] + header +
                 self.html[self.html.index("</font>") + 7:])
         self._parent.printing.SetName(_("Search Results"))
@@ -327,7 +657,9 @@ class SearchPane(wx.Panel):
     def OnHtmlLinkClicked(self, event):
         href = event.GetLinkInfo().GetHref()
         if not href.startswith("@"):
+            # Results of all versions are opened in the current tab
             if (self._parent.notebook.GetSelection() != self.last_search[2] and
+                    not self.is_all_versions(self.last_search[2]) and
                     not wx.GetKeyState(wx.WXK_CONTROL)):
                 self._parent.notebook.SetSelection(self.last_search[2])
             self._parent.load_chapter(*[int(i) for i in href.split(".")])
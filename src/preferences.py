@@ -2,7 +2,6 @@
 
 import glob
 import os
-import pickle
 import shutil
 import textwrap
 
@@ -10,6 +9,7 @@ import wx
 from wx import adv
 
 import sword
+from bible import is_removed, remove_bible, replace_bible
 from constants import BOOK_NAMES, FONT_SIZES
 from utils import download_version, import_version
 
@@ -94,8 +94,14 @@ class PreferencesDialog(wx.Dialog):
         self.remove_version = wx.Button(self.installed, label=_("Remove"))
         self.remove_version.Disable()
         self.remove_version.Bind(wx.EVT_BUTTON, self.OnRemoveVersion)
+        self.positionless_versions = set(parent.search.positionless_versions)
+        self.word_positions = wx.CheckBox(self.installed,
+                                          label=_("Index word positions for faster phrase search"))
+        self.word_positions.Disable()
+        self.word_positions.Bind(wx.EVT_CHECKBOX, self.OnWordPositions)
         sizer = wx.BoxSizer(wx.VERTICAL)
         sizer.Add(self.version_listbox, 1, wx.EXPAND)
+        sizer.Add(self.word_positions, 0, wx.ALL, 3)
         sizer2 = wx.BoxSizer(wx.HORIZONTAL)
         sizer2.Add(self.add_versions, 1, wx.LEFT | wx.ALIGN_CENTER_VERTICAL, 3)
         sizer2.Add(self.remove_version, 0, wx.RIGHT | wx.EXPAND, 3)
@@ -157,17 +163,19 @@ class PreferencesDialog(wx.Dialog):
             self.version_listbox.Clear()
         version_files = glob.glob(os.path.join(self._parent._app.cwd, "versions", "*.bbl"))
         if self._parent._app.userdatadir != self._parent._app.cwd:
-            version_files.extend(glob.glob("%s\\*.bbl" % self._parent._app.version_dir))
+            version_files.extend(glob.glob(os.path.join(self._parent._app.version_dir, "*.bbl")))
+        version_files = [filename for filename in version_files if not is_removed(filename)]
         version_files.sort(key=os.path.basename)
+        self._parent.catalog.prune(version_files)
         self.version_names = []
         for i in range(len(version_files)):
             self.version_names.append(os.path.basename(version_files[i])[:-4])
-            with open(version_files[i], 'rb') as fileobj:
-                version_description = pickle.load(fileobj)["description"]
+            version_description = self._parent.catalog.get_metadata(version_files[i])["description"]
             item_text = "%s - %s" % (self.version_names[i], version_description)
             self.version_listbox.Append(textwrap.shorten(item_text, 100), version_files[i])
             if self.version_names[i] in self._parent.version_list:
                 self.version_listbox.Check(i)
+        self._parent.catalog.save()
 
     def LoadAvailableVersions(self, use_cache=True):
         if not self.version2_listbox.IsEmpty():
@@ -190,6 +198,18 @@ class PreferencesDialog(wx.Dialog):
         version_file = event.GetClientObject()
         if version_file:
             self.remove_version.Enable(os.access(version_file, os.W_OK))
+            self.word_positions.Enable()
+            self.word_positions.SetValue(self.version_names[event.GetSelection()] not in
+                                         self.positionless_versions)
+
+    def OnWordPositions(self, event):
+        selection = self.version_listbox.GetSelection()
+        if selection == wx.NOT_FOUND:
+            return
+        elif event.IsChecked():
+            self.positionless_versions.discard(self.version_names[selection])
+        else:
+            self.positionless_versions.add(self.version_names[selection])
 
     def OnAddVersions(self, event):
         dialog = wx.FileDialog(self, _("Add versions"), self._parent._app.version_dir,
@@ -198,7 +218,9 @@ class PreferencesDialog(wx.Dialog):
         if dialog.ShowModal() == wx.ID_OK:
             for path in dialog.GetPaths():
                 if not path.endswith(".zip"):
-                    shutil.copy(path, self._parent._app.version_dir)
+                    filename = os.path.join(self._parent._app.version_dir, os.path.basename(path))
+                    shutil.copy(path, filename + ".tmp")
+                    replace_bible(filename + ".tmp", filename)
                 else:
                     import_version(path, self._parent._app.version_dir)
             self.LoadInstalledVersions()
@@ -209,13 +231,11 @@ class PreferencesDialog(wx.Dialog):
                                "Berean", wx.ICON_WARNING | wx.YES_NO)
         if delete == wx.YES:
             selection = self.version_listbox.GetSelection()
-            os.remove(self.version_listbox.GetClientData(selection))
+            remove_bible(self.version_listbox.GetClientData(selection))
             self.version_listbox.Delete(selection)
             version_name = self.version_names.pop(selection)
             if version_name in self._parent.version_list:
                 self._parent.version_list.remove(version_name)
-            if version_name not in self._parent.old_versions:
-                self._parent.old_versions.append(version_name)
 
     def OnVersionRepoSelect(self, event):
         self.LoadAvailableVersions()
@@ -267,12 +287,7 @@ class PreferencesDialog(wx.Dialog):
                                self._parent.printing):
                 htmlwindow.SetStandardFonts(**default_font)
             self._parent.default_font = default_font
-        if version_list != self._parent.version_list:
-            for version in set(sorted(self._parent.version_list + version_list)):
-                if version in self._parent.version_list and version not in version_list:
-                    self._parent.old_versions.append(version)
-                elif version in version_list and version in self._parent.old_versions:
-                    self._parent.old_versions.remove(version)
+        if version_list != self._parent.version_list:  # Unused indexes are deleted on restart
             self._parent.version_list = version_list
         self._parent._app.single_instance = self.single_instance.GetValue()
         self._parent._app.SetSingleInstance(self._parent._app.single_instance)
@@ -284,6 +299,12 @@ class PreferencesDialog(wx.Dialog):
             self._parent.search.abbrev_results = self.abbrev_results2.GetValue()
         else:
             self._parent.search.abbrev_results = -1
+        changed_versions = self.positionless_versions.symmetric_difference(
+            self._parent.search.positionless_versions)
+        self._parent.search.positionless_versions = sorted(self.positionless_versions)
+        for version in changed_versions:  # Other versions are reindexed when they are loaded
+            if version in self._parent.search.indexes:
+                self._parent.search.rebuild_index(version)
         if needs_restart:
             response = wx.MessageBox(_("Changes to language and version settings will take effect after you restart "
                 "Berean.\n\nDo you want to restart the app now?"), "Question", wx.ICON_QUESTION | wx.YES_NO)
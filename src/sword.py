@@ -3,7 +3,6 @@ import ftplib
 import hashlib
 import multiprocessing
 import os
-import pickle
 import sys
 import tarfile
 import tempfile
@@ -15,23 +14,24 @@ from itertools import chain
 
 from pysword.modules import SwordModules
 
+from bible import write_bible
 from constants import BOOK_LENGTHS, BOOK_NAMES, CHAPTER_LENGTHS
+from index import iter_runs
 
 
 def convert_bible(import_path, out_file, progress_callback):
     sword_bible = Bible(import_path)
     ber_bible = [sword_bible[0]] + [None for b in range(len(BOOK_NAMES))]
+    tags = {}
     with multiprocessing.Pool() as pool:
         for i, results in enumerate(pool.imap(_convert_book, [(import_path, b) for b in range(1, len(sword_bible))])):
             if results is not None:
                 progress_callback(i + 1)
                 ber_bible[results[0]] = results[1]
+                tags.update(((results[0], c, v), values) for (c, v), values in results[2].items())
     del sword_bible
     progress_callback(len(BOOK_NAMES) + 1)
-    with open(out_file, 'wb') as fileobj:
-        pickle.dump(ber_bible[0], fileobj)
-        ber_bible[0] = None
-        pickle.dump(ber_bible, fileobj)
+    write_bible(out_file, ber_bible, tags=tags)
 
 
 def get_master_repo_list():
@@ -45,6 +45,7 @@ def _convert_book(args):
     import_path, book_num = args
     sword_bible = Bible(import_path)
     book_obj = [str(sword_bible[book_num][0]) or None]
+    book_tags = {}
     for c in range(1, BOOK_LENGTHS[book_num - 1] + 1):
         if c >= len(sword_bible[book_num]):
             book_obj.append(None)
@@ -55,7 +56,10 @@ def _convert_book(args):
                 if v >= len(sword_bible[book_num][c]):
                     book_obj[-1].append(None)
                 else:
-                    verse_text = str(sword_bible[book_num][c][v])
+                    verse = sword_bible[book_num][c][v]
+                    verse_text = str(verse)
+                    if verse.tags:
+                        book_tags[(c, v)] = verse.tags
                     if form_feed:
                         verse_text = "\xb6 " + verse_text
                         form_feed = False
@@ -68,7 +72,7 @@ def _convert_book(args):
     except ValueError:
         return
     del sword_bible
-    return book_num, book_obj
+    return book_num, book_obj, book_tags
 
 
 class Bible(Sequence):
@@ -142,7 +146,10 @@ class Subtitle(str):
 
 class Verse(str):
     def __new__(cls, data):
-        return str.__new__(cls, VerseParser(data, exclude_tags=["note", "title"]))
+        parser = VerseParser(data, exclude_tags=["note", "title"])
+        verse = str.__new__(cls, parser)
+        verse.tags = parser.get_tags()
+        return verse
 
 
 class VerseParser(HTMLParser):
@@ -153,6 +160,8 @@ class VerseParser(HTMLParser):
         self._include_tags = include_tags or []
         self._output = None
         self._tags = []
+        self._word = None
+        self._words = []  # Start, end, lemma and morph of each <w> element in the output
 
     def _tag_matches(self, tags):
         for tag_sub in tags:
@@ -165,6 +174,19 @@ class VerseParser(HTMLParser):
             self.feed(self._data)
         return self._output or ""
 
+    def get_tags(self):
+        # Returns the (run, lemma, morph) of each run of word characters in the output that is
+        # inside a <w> element, where run is its number in the verse like in search indexes
+        output = str(self)
+        tags = []
+        i = 0
+        for run, match in enumerate(iter_runs(output)):
+            while i < len(self._words) and self._words[i][1] <= match.start():
+                i += 1
+            if i < len(self._words) and self._words[i][0] <= match.start():
+                tags.append((run, self._words[i][2], self._words[i][3]))
+        return tags
+
     def handle_starttag(self, tag, attrs):
         attrs = dict(attrs)
         self._tags.append(tag if attrs.get("type") is None else f"{tag}:{attrs['type']}")
@@ -172,9 +194,15 @@ class VerseParser(HTMLParser):
             self._output = ("" if self._output is None else f"{self._output} ") + attrs["marker"] + " "
         elif tag == "milestone" and attrs.get("type") == "line" and self._output is not None:
             self._output += "\x0c"
+        elif tag == "w" and ("lemma" in attrs or "morph" in attrs):
+            self._word = (len(self._output or ""), attrs.get("lemma"), attrs.get("morph"))
 
     def handle_endtag(self, tag):
         self._tags = [t for t in self._tags if t != tag and not t.startswith(f"{tag}:")]
+        if tag == "w" and self._word is not None:
+            start, lemma, morph = self._word
+            self._words.append((start, len(self._output or ""), lemma, morph))
+            self._word = None
 
     def handle_data(self, data):
         if self._include_tags and not self._tag_matches(self._include_tags):
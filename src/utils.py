@@ -1,15 +1,22 @@
+import multiprocessing
 import os.path
-import pickle
-import re
+import queue
 import shutil
+import threading
 
 import wx
+from wx.lib import newevent
 
 import sword
 from constants import BOOK_NAMES
+from index import build_dictionaries, build_index, get_fingerprint, open_index, write_index
 
 _ = wx.GetTranslation
 
+IndexProgressEvent, EVT_INDEX_PROGRESS = newevent.NewEvent()
+IndexDoneEvent, EVT_INDEX_DONE = newevent.NewEvent()
+IndexLoadedEvent, EVT_INDEX_LOADED = newevent.NewEvent()
+
 
 def download_version(version_data, repo, out_dir):
     version_name = version_data["abbreviation"]
@@ -32,28 +39,64 @@ def import_version(in_file, out_dir):
     dialog.Destroy()
 
 
-def index_version(version, Bible, index_dir):
-    dialog = wx.ProgressDialog(_("Indexing %s") % version, "", 68)
-    index = {}
-    for b in range(1, len(Bible)):
-        dialog.Update(b - 1, _("Processing %s...") % BOOK_NAMES[b - 1])
-        if not Bible[b]:
-            continue
-        for c in range(1, len(Bible[b])):
-            if not Bible[b][c]:
-                continue
-            for v in range(1, len(Bible[b][c])):
-                if not Bible[b][c][v]:
-                    continue
-                verse = re.sub(r"[^\w\s'\-]", r"", Bible[b][c][v].replace("--", " "),
-                               flags=re.UNICODE)
-                for word in set(verse.split()):  # Remove duplicates
-                    index.setdefault(word, []).extend([chr(i) for i in (b, c, v)])
-    dialog.Update(66, _("Saving index..."))
-    for word in index:
-        index[word] = "".join(index[word])
-    with open(os.path.join(index_dir, "%s.idx" % version), 'wb') as fileobj:
-        pickle.dump(index, fileobj, -1)
-    dialog.Update(68)
-    dialog.Destroy()
-    return index
+class IndexQueue:
+    # Builds queued indexes one at a time on a background thread, and posts progress events to
+    # their windows. The indexes share one process pool, which is closed when the queue is empty
+    def __init__(self):
+        self.pool = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def add(self, window, version, Bible, index_dir, word_positions=True):
+        with self._lock:
+            self._queue.put((window, version, Bible, index_dir, word_positions))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._queue.empty():
+                    pool, self.pool, self._thread = self.pool, None, None
+                    break
+            if self.pool is None:
+                self.pool = multiprocessing.Pool()
+            self._index_version(*self._queue.get())
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def _index_version(self, window, version, Bible, index_dir, word_positions):
+        filename = os.path.join(index_dir, "%s.idx" % version)
+        try:
+            write_index(filename, *build_dictionaries(*build_index(
+                Bible, lambda b: wx.PostEvent(window, IndexProgressEvent(version=version, book=b)),
+                word_positions, pool=self.pool)), get_fingerprint(Bible))
+        except Exception as exc:
+            wx.PostEvent(window, IndexDoneEvent(version=version, filename=None, error=exc))
+        else:
+            wx.PostEvent(window, IndexDoneEvent(version=version, filename=filename, error=None))
+
+    def terminate(self):
+        # Stops the workers of the index being built, when the application closes
+        pool = self.pool
+        if pool is not None:
+            pool.terminate()
+
+
+def load_index(window, version, index_dir):
+    # Opens the index on a background thread, and reads it into the page cache
+    def run():
+        try:
+            index = open_index(os.path.join(index_dir, "%s.idx" % version))
+            index.prefetch()
+        except (IOError, ValueError) as exc:
+            wx.PostEvent(window, IndexLoadedEvent(version=version, index=None, error=exc))
+        else:
+            wx.PostEvent(window, IndexLoadedEvent(version=version, index=index, error=None))
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread